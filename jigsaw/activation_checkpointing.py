@@ -0,0 +1,120 @@
+"""
+Activation checkpointing: activations of checkpointed layers are not kept
+for backward but recomputed, trading step time for memory.
+Compare peak memory and step time with::
+
+    python -m jigsaw.activation_checkpointing bert-base-uncased --every 0 1 2
+"""
+import argparse
+from functools import partial
+import inspect
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+# non-reentrant checkpointing works with inputs which do not require grad,
+# but is not available in older torch versions
+_CHECKPOINT_KWARGS = (
+    {'use_reentrant': False}
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters else {})
+
+
+def checkpoint_layers(layers: nn.ModuleList, every: int = 1) -> int:
+    """ Checkpoint every ``every``-th layer, returning number of checkpointed
+    layers. Only ``forward`` of layer instances is replaced, so parameter
+    names and saved weights are not affected.
+    """
+    n_checkpointed = 0
+    for i, layer in enumerate(layers):
+        if every and i % every == 0:
+            layer.forward = partial(_checkpointed_forward, layer.forward)
+            n_checkpointed += 1
+    return n_checkpointed
+
+
+def _checkpointed_forward(forward, *args):
+    if torch.is_grad_enabled():
+        return checkpoint(forward, *args, **_CHECKPOINT_KWARGS)
+    return forward(*args)
+
+
+def main():
+    """ Train a classifier for a few steps with different checkpointing
+    settings, reporting peak memory and step time.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    arg = parser.add_argument
+    arg('model')
+    arg('--every', type=int, nargs='+', default=[0, 1, 2, 4],
+        help='checkpoint every k-th layer, 0 to disable')
+    arg('--steps', type=int, default=20)
+    arg('--warmup-steps', type=int, default=3,
+        help='steps excluded from step time')
+    arg('--batch-size', type=int, default=32)
+    arg('--seq-length', type=int, default=296)
+    arg('--precision')
+    args = parser.parse_args()
+
+    # each setting is run in a new process to measure peak memory
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for every in args.every:
+        with ctx.Pool(1) as pool:
+            results[every] = pool.apply(_benchmark, (args, every))
+    baseline = results.get(0)
+    for every, result in results.items():
+        line = (f'every {every}: {result["n_checkpointed"]} layers '
+                f'checkpointed, peak memory {result["peak_mb"]:,.0f} MB, '
+                f'step {result["step_ms"]:.0f} ms')
+        if baseline is not None and every != 0:
+            line += (f', memory {result["peak_mb"] / baseline["peak_mb"]:.2f}x'
+                     f', step time {result["step_ms"] / baseline["step_ms"]:.2f}x')
+        print(line)
+
+
+def _benchmark(args, every: int):
+    from .bert import (
+        device, enable_activation_checkpointing, get_loss, load_model,
+        load_tokenizer, train)
+    from .precision import get_precision
+
+    _, pad_idx = load_tokenizer(args.model)
+    rng = np.random.RandomState(42)
+    n_samples = args.steps * args.batch_size
+    x_train = rng.randint(1000, 2000, size=(n_samples, args.seq_length))
+    y_train = rng.rand(n_samples, 8).astype(np.float32)
+    model = load_model(args.model).to(device)
+    n_checkpointed = enable_activation_checkpointing(model, every)
+    if device.type == 'cuda':
+        torch.cuda.reset_max_memory_allocated()
+    times = []
+    for state in train(
+            model=model, criterion=partial(get_loss, loss_weight=1.),
+            x_train=x_train, y_train=y_train, epochs=1, yield_steps=1,
+            bucket=False, lr=1e-5, batch_size=args.batch_size,
+            accumulation_steps=1, pad_idx=pad_idx,
+            precision=get_precision(args.precision, device)):
+        if state[-1]['train_step'] > len(times):  # once per step
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.perf_counter())
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        # process peak resident memory, in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        'n_checkpointed': n_checkpointed,
+        'peak_mb': peak / 2 ** 20,
+        'step_ms': 1000 * float(np.mean(np.diff(times[args.warmup_steps:]))),
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Averaging of model weights over training steps, exponential (EMA)
+or stochastic (SWA), so that a single model with averaged weights
+replaces an ensemble of checkpoints and needs one inference pass.
+"""
+import contextlib
+from typing import Dict
+
+import torch
+from torch import nn
+
+
+AVERAGE_KINDS = ['ema', 'swa']
+
+
+class WeightAverage:
+    """ Averaged copies of trainable parameters of ``model``,
+    updated in place by ``update`` after optimizer steps.
+
+    With ``kind='ema'``, each update moves averaged weights towards
+    current ones by ``1 - decay`` (with a warmup of the decay, so that
+    first updates are not dominated by initial weights), with
+    ``kind='swa'`` all updates have equal weights. Updates start after
+    ``start`` calls of ``update`` and happen every ``every`` calls.
+
+    Only parameters are averaged, buffers are taken from the trained model.
+    This is exact for models without batch normalization (all models
+    here), otherwise its statistics need to be recomputed for
+    averaged weights.
+    """
+    def __init__(self, model: nn.Module, *, kind: str = 'ema',
+                 decay: float = 0.999, start: int = 0, every: int = 1):
+        if kind not in AVERAGE_KINDS:
+            raise ValueError(f'unknown kind of averaging {kind}')
+        self.kind = kind
+        self.decay = decay
+        self.start = start
+        self.every = every
+        self.step = 0
+        self.n_averaged = 0
+        self.params = {name: p.detach().float().clone()
+                       for name, p in _params(model)}
+
+    def update(self, model: nn.Module):
+        self.step += 1
+        if self.step <= self.start or (self.step - self.start) % self.every:
+            return
+        self.n_averaged += 1
+        n = self.n_averaged
+        if n == 1:
+            weight = 1.
+        elif self.kind == 'swa':
+            weight = 1 / n
+        else:
+            weight = 1 - min(self.decay, (1 + n) / (10 + n))
+        with torch.no_grad():
+            for name, p in _params(model):
+                self.params[name].lerp_(p.detach().float(), weight)
+
+    def state_dict(self) -> Dict:
+        return {'step': self.step, 'n_averaged': self.n_averaged,
+                'params': self.params}
+
+    def load_state_dict(self, state: Dict):
+        self.step = state['step']
+        self.n_averaged = state['n_averaged']
+        for name, value in state['params'].items():
+            self.params[name].copy_(value)
+
+    def averaged_state_dict(self, model: nn.Module) -> Dict:
+        """ State dict of ``model`` with averaged weights, or with current
+        weights if nothing was averaged yet.
+        """
+        state = getattr(model, 'module', model).state_dict()
+        if self.n_averaged:
+            for name, value in self.params.items():
+                state[name] = value.to(state[name].dtype)
+        return state
+
+    def copy_to(self, model: nn.Module):
+        """ Replace weights of ``model`` with averaged ones.
+        """
+        if not self.n_averaged:
+            return
+        with torch.no_grad():
+            for name, p in _params(model):
+                p.copy_(self.params[name])
+
+    @contextlib.contextmanager
+    def swapped(self, model: nn.Module):
+        """ Use averaged weights in ``model`` inside the block,
+        e.g. for validation, restoring trained weights after it.
+        """
+        if not self.n_averaged:
+            yield model
+            return
+        trained = {name: p.detach().clone() for name, p in _params(model)}
+        self.copy_to(model)
+        try:
+            yield model
+        finally:
+            with torch.no_grad():
+                for name, p in _params(model):
+                    p.copy_(trained[name])
+
+
+def _params(model: nn.Module):
+    # weights without the DistributedDataParallel wrapper
+    model = getattr(model, 'module', model)
+    return [(name, p) for name, p in model.named_parameters()
+            if p.requires_grad]
@@ -3,17 +3,21 @@ Initial version based on
 https://www.kaggle.com/yuval6967/toxic-bert-plain-vanila/
 """
 import argparse
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import datetime
+from itertools import islice
 import json
 from functools import partial
 import shutil
 from pathlib import Path
 import os
+import queue
+import random
+import time
+import traceback
 
-try:
-    from apex import amp
-except ImportError:
-    amp = None
 try:
     import json_log_plots
 except ImportError:
@@ -21,16 +25,29 @@ except ImportError:
 import numpy as np
 import pandas as pd
 from pytorch_pretrained_bert import (
-    BertTokenizer, BertForSequenceClassification, BertAdam,
+    BertForSequenceClassification, BertAdam,
     GPT2Tokenizer, OpenAIAdam, GPT2Model, WEIGHTS_NAME, CONFIG_NAME)
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch import distributed as dist
 from torch import multiprocessing
 from torch.utils.data import TensorDataset, DataLoader
-from torch.utils.data.sampler import BatchSampler, RandomSampler
+from torch.utils.data.sampler import BatchSampler, Sampler
 import tqdm
 
+from .activation_checkpointing import checkpoint_layers
+from .averaging import AVERAGE_KINDS, WeightAverage
+from .early_exit import EarlyExitBert
+from .oom import AdaptiveBatchSize, OutOfMemoryInUpdate, is_oom
+from .precision import PRECISIONS, Precision, get_precision
+from .prediction_cache import (
+    DedupedTexts, PredictionCache, model_fingerprint)
+from .prefetch import PrefetchLoader
+from .streaming import IdOrderedCsvWriter, read_chunks
+from .token_cache import cached_tokens
+from .wordpiece import TrieBertTokenizer
+
 if 'KAGGLE_WORKING_DIR' in os.environ:
     ON_KAGGLE = True
     DATA_ROOT = Path(
@@ -40,8 +57,12 @@ else:
     from .utils import DATA_ROOT, ON_KAGGLE
 
 
-device = torch.device('cuda')
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 GPT2_PAD = '<pad>'
+# mapping of token ids to rows of a trimmed embedding matrix,
+# saved next to the vocabulary by jigsaw.compact
+VOCAB_REMAP_NAME = 'vocab-remap.npy'
+NUM_LABELS = 7
 
 
 def main():
@@ -57,30 +78,93 @@ def main():
     arg('--epochs', type=int, default=2)
     arg('--validation', action='store_true')
     arg('--submission', action='store_true')
+    arg('--teacher-logits', action='store_true',
+        help='save logits of the best model for all training texts '
+             'to distill it into other models')
     arg('--lr', type=float, default=2e-5)
     arg('--batch-size', type=int, default=32)
     arg('--accumulation-steps', type=int, default=2)
     arg('--checkpoint-interval', type=int)
     arg('--clean', action='store_true')
+    arg('--precision', choices=PRECISIONS,
+        help='mixed precision policy, by default apex if installed '
+             'or fp16 on CUDA, and fp32 on CPU')
+    arg('--activation-checkpointing', type=int, default=0, metavar='K',
+        help='recompute activations of every K-th encoder layer '
+             'in backward to save memory, 0 to disable')
+    arg('--early-exit-layers', type=int, nargs='+', metavar='LAYER',
+        help='add classification heads after these encoder layers, '
+             'trained jointly with the final head')
+    arg('--exit-threshold', type=float,
+        help='for validation and submission, stop texts at the first head '
+             'with toxicity probability above it or below 1 - it')
+    arg('--average', choices=AVERAGE_KINDS,
+        help='validate and keep as the best model averaged weights: '
+             'exponential (ema) or equal (swa) average over steps')
+    arg('--average-decay', type=float, default=0.999)
+    arg('--average-start', type=int, default=0,
+        help='optimizer steps before averaging starts')
+    arg('--average-every', type=int, default=1,
+        help='average weights every this many optimizer steps')
+    arg('--resume', action='store_true',
+        help='continue training from the last checkpoint in run_root')
+    arg('--seed', type=int, default=42)
     arg('--fold', type=int, default=0)
+    arg('--folds', help='json file with validation ids of each fold, '
+                        'by default data/folds.json')
+    arg('--token-cache',
+        help='directory to keep token ids of all training texts in, '
+             'shared between folds')
     arg('--bucket', type=int, default=1)
+    arg('--chunk-size', type=int, default=20000,
+        help='rows of test.csv predicted at once with --submission')
+    arg('--tokenize-workers', type=int)
+    arg('--prediction-cache', help='sqlite file to cache predictions in')
+    arg('--prediction-cache-size', type=int, default=10 ** 7)
     arg('--load-weights', help='load weights for training')
     arg('--export', help='export everything for inference')
+    arg('--async-validation', action='store_true',
+        help='validate checkpoints in a separate process')
+    arg('--validation-device', default='cpu')
+    arg('--validation-threads', type=int, default=4)
+    arg('--validation-queue', type=int, default=2,
+        help='snapshots waiting for async validation before training '
+             'waits for the validation process')
+    arg('--ddp-workers', type=int, default=1,
+        help='data-parallel training processes on this machine (CPU, gloo)')
+    arg('--ddp-threads', type=int,
+        help='threads per process, by default all cores are divided')
+    arg('--ddp-nodes', type=int, default=1)
+    arg('--ddp-node-rank', type=int, default=0)
+    arg('--ddp-master', default='127.0.0.1:29500',
+        help='address and port of the node with rank 0')
+    arg('--ddp-timeout', type=float, default=180,
+        help='minutes to wait in collectives, other ranks wait for '
+             'rank 0 while it validates synchronously')
     args = parser.parse_args()
+    use_ddp = args.ddp_workers > 1 or args.ddp_nodes > 1
+    if use_ddp and args.precision in {'fp16', 'apex'}:
+        parser.error(f'--precision {args.precision} needs CUDA, '
+                     f'DDP workers train on CPU: use bf16 or fp32')
 
     run_root = Path(args.run_root)
-    do_train = not (args.submission or args.validation or args.export)
-    if do_train:
+    do_train = not (args.submission or args.validation or args.export or
+                    args.teacher_logits)
+    if do_train and args.ddp_node_rank == 0:
         if args.clean and run_root.exists():
             if input(f'Clean "{run_root.absolute()}"? ') == 'y':
                 shutil.rmtree(run_root)
-        if run_root.exists():
+        if args.resume:
+            if not (run_root / 'optimizer.pt').exists():
+                parser.error(f'no checkpoint to resume in {run_root}')
+        elif run_root.exists():
             parser.error(f'{run_root} exists')
         run_root.mkdir(exist_ok=True, parents=True)
         params_str = json.dumps(vars(args), indent=4)
         print(params_str)
-        (run_root / 'params.json').write_text(params_str)
-        shutil.copy(__file__, run_root)
+        if not args.resume:
+            (run_root / 'params.json').write_text(params_str)
+            shutil.copy(__file__, run_root)
     else:
         run_root.mkdir(exist_ok=True, parents=True)
 
@@ -91,213 +175,707 @@ def main():
                 (use_gpt2 and 'gpt2' not in args.export)):
             parser.error("Can't determine model kind from the --export option")
 
-    print('Loading tokenizer...')
-    if use_bert:
-        tokenizer = BertTokenizer.from_pretrained(
-            args.model, do_lower_case='uncased' in args.model)
-        pad_idx = 0
-    elif use_gpt2:
-        tokenizer = GPT2Tokenizer.from_pretrained(args.model)
-        tokenizer.set_special_tokens([GPT2_PAD])
-        pad_idx, = tokenizer.convert_tokens_to_ids([GPT2_PAD])
-    else:
-        raise ValueError(f'Unexpected model {args.model}')
-
-    print('Loading model...')
-    model_is_path = Path(args.model).exists()
-    num_labels = 7
-    if use_bert:
-        model = BertForSequenceClassification.from_pretrained(
-            args.model, num_labels=num_labels)
-    else:
-        model = GPT2ClassificationHeadModel(args.model, num_labels=num_labels)
-        model.transformer.set_num_special_tokens(1)
-        if model_is_path:
-            # to also load linear layer weights
-            model.load_state_dict(
-                torch.load(Path(args.model) / 'pytorch_model.bin'))
-
-    model_path = run_root / 'model.pt'
-    optimizer_path = run_root / 'optimizer.pt'
-    best_model_path = run_root / 'model-best.pt'
-    valid_predictions_path = run_root / 'valid-predictions.csv'
+    if args.exit_threshold and not args.early_exit_layers:
+        parser.error('--exit-threshold needs --early-exit-layers')
 
+    print('Loading tokenizer...')
+    tokenizer, pad_idx = load_tokenizer(args.model)
     if args.export:
-        model.load_state_dict(torch.load(best_model_path))
+        print('Loading model...')
+        model = load_model(args.model,
+                           early_exit_layers=args.early_exit_layers)
+        model.load_state_dict(torch.load(run_root / 'model-best.pt'))
         export_path = Path(args.export)
         export_path.mkdir(exist_ok=True, parents=True)
         torch.save(model.state_dict(), export_path / WEIGHTS_NAME)
         model.config.to_json_file(export_path / CONFIG_NAME)
         tokenizer.save_vocabulary(export_path)
+        if getattr(tokenizer, 'id_remap', None) is not None:
+            np.save(export_path / VOCAB_REMAP_NAME, tokenizer.id_remap)
         return
 
+    # start workers before the model is loaded and moved to the device
+    with TokenizerPool(tokenizer, use_bert=use_bert, pad_idx=pad_idx,
+                       processes=args.tokenize_workers) as tokenizer_pool:
+        _run(args, tokenizer=tokenizer, pad_idx=pad_idx,
+             tokenizer_pool=tokenizer_pool, do_train=do_train)
+
+
+def _run(args, *, tokenizer, pad_idx: int, tokenizer_pool: 'TokenizerPool',
+         do_train: bool):
+    """ Train, validate or predict, as selected by ``args`` of main.
+    """
+    run_root = Path(args.run_root)
+    use_bert = 'bert' in args.model
+    use_ddp = args.ddp_workers > 1 or args.ddp_nodes > 1
+
+    print('Loading model...')
+    seed_everything(args.seed)
+    model_is_path = Path(args.model).exists()
+    model = load_model(args.model, early_exit_layers=args.early_exit_layers)
+    if args.exit_threshold:
+        model.threshold = args.exit_threshold
+    if do_train and args.activation_checkpointing:
+        n_checkpointed = enable_activation_checkpointing(
+            model, args.activation_checkpointing)
+        print(f'Activation checkpointing for {n_checkpointed} layers')
+
+    best_model_path = run_root / 'model-best.pt'
+    valid_predictions_path = run_root / 'valid-predictions.csv'
+
     model = model.to(device)
+    precision = get_precision(args.precision, device)
+    print(f'Using {precision.name} precision')
+
+    def _prediction_cache(seq_length: int):
+        if not args.prediction_cache:
+            return None
+        fingerprint = model_fingerprint(
+            model, model_name=args.model, seq_length=seq_length,
+            precision=precision.name)
+        return PredictionCache(args.prediction_cache, fingerprint,
+                               max_size=args.prediction_cache_size)
 
     if args.submission:
         if not model_is_path:
             model.load_state_dict(torch.load(best_model_path))
-        if amp is not None:
-            model = amp.initialize(model, opt_level='O1', verbosity=0)
+        prediction_cache = _prediction_cache(args.test_seq_length)
+        model, _ = precision.prepare(model)
         make_submission(model=model, tokenizer=tokenizer,
+                        precision=precision,
                         run_root=run_root, max_seq_length=args.test_seq_length,
                         batch_size=args.batch_size,
                         pad_idx=pad_idx,
                         use_bert=use_bert,
                         bucket=args.bucket,
-                        test_size=args.test_size)
+                        test_size=args.test_size,
+                        chunk_size=args.chunk_size,
+                        tokenizer_pool=tokenizer_pool,
+                        prediction_cache=prediction_cache)
         return
 
     train_pkl_path = DATA_ROOT / 'train.pkl'
     if not train_pkl_path.exists():
         pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
     df = pd.read_pickle(train_pkl_path)
-    df = preprocess_df(df)
-
-    folds = json.loads((DATA_ROOT / 'folds.json').read_text())
+    df = preprocess_df(df).reset_index(drop=True)
+
+    def _tokenize(texts, seq_length: int, index: np.ndarray) -> np.ndarray:
+        """ Tokenize ``texts`` which are rows ``index`` of ``df``,
+        taking them from the token cache of all rows if it is set.
+        """
+        tokenize_texts = partial(
+            tokenize_lines, max_seq_length=seq_length, tokenizer=tokenizer,
+            use_bert=use_bert, pad_idx=pad_idx, pool=tokenizer_pool)
+        if not args.token_cache:
+            return tokenize_texts(texts)
+        all_tokens = cached_tokens(
+            Path(args.token_cache), list(df['comment_text']), tokenize_texts,
+            model=args.model, seq_length=seq_length)
+        return np.array(all_tokens[index])
+
+    folds_path = Path(args.folds) if args.folds else DATA_ROOT / 'folds.json'
+    folds = json.loads(folds_path.read_text())
     valid_index = df['id'].isin(folds[args.fold])
+
+    if args.teacher_logits:
+        if not model_is_path:
+            model.load_state_dict(torch.load(best_model_path))
+        model, _ = precision.prepare(model)
+        texts = DedupedTexts(
+            df['comment_text'],
+            cache=_prediction_cache(args.test_seq_length), normalize=use_bert)
+        x = _tokenize(texts.texts, args.test_seq_length,
+                      df.index.values[texts.indices])
+        start = time.perf_counter()
+        logits = texts.scatter(predict(
+            model, x, batch_size=args.batch_size, pad_idx=pad_idx,
+            bucket=args.bucket, precision=precision, desc='teacher'))
+        path = run_root / 'teacher-logits.npz'
+        # rows of the validation fold, which the teacher was not trained on
+        np.savez(path, ids=df['id'].values, logits=logits.astype(np.float16),
+                 out_of_fold=valid_index.values,
+                 texts_per_s=len(x) / (time.perf_counter() - start))
+        print(f'Saved logits for {len(logits):,} texts to {path}, '
+              f'{valid_index.sum():,} of them out-of-fold')
+        return
+
     df_train, df_valid = df[~valid_index], df[valid_index]
     if args.train_size and len(df_train) > args.train_size:
         df_train = df_train.sample(n=args.train_size, random_state=42)
     if args.valid_size and len(df_valid) > args.valid_size:
         df_valid = df_valid.sample(n=args.valid_size, random_state=42)
 
-    x_valid = tokenize_lines(
-        df_valid.pop('comment_text'), args.test_seq_length, tokenizer,
-        use_bert=use_bert, pad_idx=pad_idx)
-    if args.bucket:
-        indices, x_valid = sorted_by_length(x_valid, pad_idx)
-        # TODO recover original order before saving
-        df_valid = df_valid.iloc[indices]
+    if args.validation and not model_is_path:
+        model.load_state_dict(torch.load(best_model_path))
+    valid_texts = DedupedTexts(
+        df_valid.pop('comment_text'),
+        cache=_prediction_cache(args.test_seq_length)
+        if args.validation else None, normalize=use_bert)
+    print(f'{len(valid_texts.texts):,} unique uncached validation texts')
+    x_valid = _tokenize(valid_texts.texts, args.test_seq_length,
+                        df_valid.index.values[valid_texts.indices])
     y_valid, _ = get_target(df_valid)
     y_train, loss_weight = get_target(df_train)
     print(f'X_valid.shape={x_valid.shape} y_valid.shape={y_valid.shape}')
 
-    criterion = partial(get_loss, loss_weight=loss_weight)
-
-    def _run_validation():
-        return validation(
-            model=model, criterion=criterion,
-            x_valid=x_valid, y_valid=y_valid, df_valid=df_valid,
-            batch_size=args.batch_size,
-            pad_idx=pad_idx, bucket=args.bucket)
+    validation_kwargs = dict(
+        criterion=partial(get_loss, loss_weight=loss_weight),
+        x_valid=x_valid, y_valid=y_valid, df_valid=df_valid,
+        valid_texts=valid_texts,
+        batch_size=args.batch_size,
+        pad_idx=pad_idx, bucket=args.bucket)
 
     if args.validation:
-        if not model_is_path:
-            model.load_state_dict(torch.load(best_model_path))
-        if amp is not None:
-            model = amp.initialize(model, opt_level='O1', verbosity=0)
-        metrics, valid_predictions = _run_validation()
+        model, _ = precision.prepare(model)
+        metrics, valid_predictions = validation(
+            model=model, precision=precision, **validation_kwargs)
         for k, v in metrics.items():
             if isinstance(v, float):
                 print(f'{v:.4f}  {k}')
+        if args.exit_threshold:
+            print(f'{model.mean_layers:.2f}  mean layers')
         valid_predictions.to_csv(valid_predictions_path, index=None)
         print(f'Saved validation predictions to {valid_predictions_path}')
         return
 
-    def _save(step, model, optimizer):
-        torch.save(model.state_dict(), model_path)
-        torch.save({'optimizer': optimizer.state_dict(), 'step': step},
-                   optimizer_path)
+    x_train = _tokenize(df_train.pop('comment_text'), args.train_seq_length,
+                        df_train.index.values)
+    print(f'X_train.shape={x_train.shape} y_train.shape={y_train.shape}')
+
+    if use_ddp:
+        del model
+        tokenizer_pool.close()
+        # tensors are passed to workers in shared memory
+        multiprocessing.spawn(
+            _ddp_worker, nprocs=args.ddp_workers,
+            args=(args, torch.as_tensor(x_train, dtype=torch.long),
+                  torch.from_numpy(y_train), validation_kwargs))
+    else:
+        fit(args, model=model, precision=precision,
+            x_train=x_train, y_train=y_train,
+            validation_kwargs=validation_kwargs)
+
+
+def _ddp_worker(local_rank: int, args, x_train, y_train, validation_kwargs):
+    global device
+    device = torch.device('cpu')
+    rank = args.ddp_node_rank * args.ddp_workers + local_rank
+    world_size = args.ddp_nodes * args.ddp_workers
+    cpus = sorted(os.sched_getaffinity(0))
+    threads = args.ddp_threads or max(1, len(cpus) // args.ddp_workers)
+    # pin each worker to its own cores, so that workers do not compete
+    worker_cpus = cpus[local_rank * threads: (local_rank + 1) * threads]
+    if worker_cpus:
+        os.sched_setaffinity(0, worker_cpus)
+    torch.set_num_threads(threads)
+    dist.init_process_group(
+        'gloo', init_method=f'tcp://{args.ddp_master}',
+        rank=rank, world_size=world_size,
+        timeout=datetime.timedelta(minutes=args.ddp_timeout))
+    try:
+        seed_everything(args.seed)
+        model = load_model(args.model,
+                           early_exit_layers=args.early_exit_layers)
+        if args.activation_checkpointing:
+            enable_activation_checkpointing(
+                model, args.activation_checkpointing)
+        fit(args, model=model.to(device),
+            precision=get_precision(args.precision, device),
+            x_train=x_train, y_train=y_train,
+            validation_kwargs=validation_kwargs, rank=rank)
+    finally:
+        dist.destroy_process_group()
+
+
+def fit(args, *, model, precision: Precision, x_train, y_train,
+        validation_kwargs, rank: int = 0):
+    """ Train the model, saving checkpoints and validating them.
+    In distributed training, only rank 0 saves and validates.
+    """
+    run_root = Path(args.run_root)
+    model_path = run_root / 'model.pt'
+    optimizer_path = run_root / 'optimizer.pt'
+    best_model_path = run_root / 'model-best.pt'
+    valid_predictions_path = run_root / 'valid-predictions.csv'
 
-    if args.load_weights:
+    resume_state = None
+    best_auc = 0
+    if args.resume:
+        if rank == 0:
+            print(f'Resuming from {model_path}')
+        model.load_state_dict(torch.load(model_path, map_location='cpu'))
+        resume_state = torch.load(optimizer_path, map_location='cpu')
+        best_auc = best_logged_auc(run_root, resume_state['step'])
+        if rank == 0:
+            print(f'step {resume_state["step"]:,}, '
+                  f'epoch {resume_state["epoch"]}, best auc {best_auc:.4f}')
+    elif args.load_weights:
         print(f'Loading weights from {args.load_weights}')
         load_info = model.load_state_dict(
             torch.load(args.load_weights), strict=False)
-        if load_info:
+        if load_info and rank == 0:
             print(load_info)
 
-    x_train = tokenize_lines(
-        df_train.pop('comment_text'), args.train_seq_length, tokenizer,
-        use_bert=use_bert, pad_idx=pad_idx)
-    print(f'X_train.shape={x_train.shape} y_train.shape={y_train.shape}')
+    weight_average = None
+    if args.average and rank == 0:
+        weight_average = WeightAverage(
+            model, kind=args.average, decay=args.average_decay,
+            start=args.average_start, every=args.average_every)
+
+    if rank != 0:
+        for _ in train(**_train_kwargs(
+                args, model, precision, x_train, y_train,
+                validation_kwargs, resume_state)):
+            pass
+        return
 
-    best_auc = 0
-    step = optimizer = None
+    checkpoint_writer = CheckpointWriter()
+
+    def _optimizer_state(step, optimizer, train_state):
+        return dict(train_state, optimizer=optimizer.state_dict(), step=step)
+
+    def _save(step, model, optimizer, train_state):
+        checkpoint_writer.save(
+            (model.state_dict(), model_path),
+            (_optimizer_state(step, optimizer, train_state), optimizer_path))
+
+    async_validator = None
+    if args.async_validation:
+        async_validator = AsyncValidator(
+            run_root, model_name=args.model, best_auc=best_auc,
+            precision=precision.name,
+            early_exit_layers=args.early_exit_layers,
+            device=args.validation_device, threads=args.validation_threads,
+            max_pending=args.validation_queue,
+            validation_kwargs=validation_kwargs)
+
+    start_step = resume_state['step'] if resume_state else 0
     try:
-        for model, optimizer, epoch_pbar, loss, step in train(
-                model=model, criterion=criterion,
-                x_train=x_train, y_train=y_train, epochs=args.epochs,
-                yield_steps=args.checkpoint_interval or len(y_valid) // 8,
-                bucket=args.bucket,
-                lr=args.lr,
-                batch_size=args.batch_size,
-                accumulation_steps=args.accumulation_steps,
-                pad_idx=pad_idx,
-                ):
-            if step == 0:
-                continue  # step 0 allows saving on Ctrl+C from the start
-            _save(step, model, optimizer)
-            metrics, valid_predictions = _run_validation()
+        for (model, optimizer, epoch_pbar, loss, step, data_wait,
+             train_state) in train(**_train_kwargs(
+                args, model, precision, x_train, y_train,
+                validation_kwargs, resume_state),
+                weight_average=weight_average):
+            if step == start_step:
+                continue  # nothing trained yet
+            # weights without the DistributedDataParallel wrapper
+            model = getattr(model, 'module', model)
+            if async_validator is not None:
+                async_validator.reserve()
+                snapshot_path = async_validator.snapshot_path(step)
+                optimizer_state = _optimizer_state(
+                    step, optimizer, train_state)
+                if weight_average is None:
+                    checkpoint_writer.save(
+                        (model.state_dict(), snapshot_path),
+                        (optimizer_state, optimizer_path))
+                    checkpoint_writer.link(snapshot_path, model_path)
+                else:
+                    # averaged weights are validated, trained ones resumed
+                    checkpoint_writer.save(
+                        (model.state_dict(), model_path),
+                        (weight_average.averaged_state_dict(model),
+                         snapshot_path),
+                        (optimizer_state, optimizer_path))
+                checkpoint_writer.then(
+                    async_validator.submit, step, snapshot_path, loss=loss,
+                    data_wait_ms=data_wait * 1000)
+                continue
+            _save(step, model, optimizer, train_state)
+            with (weight_average.swapped(model) if weight_average
+                  else contextlib.suppress()):
+                metrics, valid_predictions = validation(
+                    model=model, precision=precision, **validation_kwargs)
             metrics['loss'] = loss
+            metrics['data_wait_ms'] = data_wait * 1000
             if metrics['auc'] > best_auc:
                 best_auc = metrics['auc']
-                shutil.copy(model_path, best_model_path)
+                if weight_average is None:
+                    checkpoint_writer.link(model_path, best_model_path)
+                else:
+                    checkpoint_writer.save(
+                        (weight_average.averaged_state_dict(model),
+                         best_model_path))
                 valid_predictions.to_csv(valid_predictions_path, index=None)
             epoch_pbar.set_postfix(valid_loss=f'{metrics["valid_loss"]:.4f}',
                                    auc=f'{metrics["auc"]:.4f}')
             json_log_plots.write_event(run_root, step=step, **metrics)
     except KeyboardInterrupt:
-        if step is not None and optimizer is not None:
-            print('Ctrl+C pressed, saving checkpoint')
-            _save(step, model, optimizer)
+        # the model may be in the middle of a step, so instead of saving it
+        # keep the last checkpoint, which can be resumed exactly
+        print('Ctrl+C pressed, waiting for checkpoint writes')
         raise
+    finally:
+        try:
+            checkpoint_writer.close()
+        finally:
+            if async_validator is not None:
+                print('Waiting for pending validations')
+                async_validator.close()
+
+
+def _train_kwargs(args, model, precision, x_train, y_train,
+                  validation_kwargs, resume_state):
+    return dict(
+        model=model, criterion=validation_kwargs['criterion'],
+        x_train=x_train, y_train=y_train, epochs=args.epochs,
+        yield_steps=(args.checkpoint_interval or
+                     len(validation_kwargs['y_valid']) // 8),
+        bucket=args.bucket,
+        lr=args.lr,
+        batch_size=args.batch_size,
+        accumulation_steps=args.accumulation_steps,
+        pad_idx=validation_kwargs['pad_idx'],
+        seed=args.seed,
+        precision=precision,
+        resume_state=resume_state,
+    )
+
+
+class AsyncValidator:
+    """ Validates checkpoint snapshots in a separate process, so that
+    training does not stop for validation.
+
+    The evaluator writes metrics to the json_log_plots log of ``run_root``,
+    and links the best snapshot to model-best.pt after it is validated.
+    At most ``max_pending`` snapshots wait for validation: ``reserve``
+    blocks training until the evaluator catches up, so that snapshots
+    do not pile up on disk. Errors of the evaluator are raised
+    in the training process by ``reserve`` and ``close``.
+    """
+    def __init__(self, run_root: Path, *, model_name: str, device: str,
+                 threads: int, validation_kwargs, best_auc: float = 0,
+                 precision: str = 'fp32', early_exit_layers=None,
+                 max_pending: int = 2):
+        self.snapshot_root = run_root / 'snapshots'
+        self.snapshot_root.mkdir(exist_ok=True)
+        self.max_pending = max_pending
+        self.n_pending = 0
+        ctx = multiprocessing.get_context('spawn')
+        self.queue = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=_async_validation_worker,
+            args=(self.queue, self.results, run_root, model_name, device,
+                  threads, validation_kwargs, best_auc, precision,
+                  early_exit_layers))
+        self.process.start()
+
+    def snapshot_path(self, step: int) -> Path:
+        return self.snapshot_root / f'model-{step}.pt'
+
+    def reserve(self):
+        """ Wait for a free place for the next snapshot.
+        """
+        self._get_results(block=False)
+        while self.n_pending >= self.max_pending:
+            self._get_results(block=True)
+        self.n_pending += 1
+
+    def submit(self, step: int, snapshot_path: Path, **metrics):
+        self.queue.put((step, snapshot_path, metrics))
+
+    def close(self):
+        self.queue.put(None)
+        try:
+            while self._get_results(block=True):
+                pass
+        finally:
+            self.process.join()
+
+    def _get_results(self, block: bool) -> bool:
+        """ Read validation results, returning False once the evaluator
+        has exited.
+        """
+        while True:
+            alive = self.process.is_alive()
+            try:
+                result = self.results.get(block, timeout=1)
+            except queue.Empty:
+                if not alive:
+                    raise RuntimeError(
+                        f'Validation process exited with code '
+                        f'{self.process.exitcode}')
+                if block:
+                    continue
+                return True
+            if result is None:
+                return False
+            step, error = result
+            if error is not None:
+                at = '' if step is None else f' at step {step:,}'
+                raise RuntimeError(f'Validation failed{at}:\n{error}')
+            self.n_pending -= 1
+            if block:
+                return True
+
+
+def _async_validation_worker(snapshots, results, run_root: Path,
+                             model_name: str, validation_device: str,
+                             threads: int, validation_kwargs, best_auc,
+                             precision_name, early_exit_layers):
+    """ Validate snapshots from ``snapshots``, putting ``(step, error)``
+    to ``results`` for each of them, and None when done.
+    """
+    global device
+    device = torch.device(validation_device)
+    torch.set_num_threads(threads)
+    step = None
+    try:
+        try:
+            precision = get_precision(precision_name, device)
+        except ValueError:
+            precision = Precision(device)  # e.g. fp16 with validation on CPU
+        model = load_model(model_name, early_exit_layers=early_exit_layers)
+        model, _ = precision.prepare(model.to(device))
+        while True:
+            item = snapshots.get()
+            if item is None:
+                break
+            step, snapshot_path, train_metrics = item
+            model.load_state_dict(
+                torch.load(snapshot_path, map_location='cpu'))
+            metrics, valid_predictions = validation(
+                model=model, precision=precision, **validation_kwargs)
+            metrics.update(train_metrics)
+            if metrics['auc'] > best_auc:
+                best_auc = metrics['auc']
+                link_file(snapshot_path, run_root / 'model-best.pt')
+                valid_predictions.to_csv(
+                    run_root / 'valid-predictions.csv', index=None)
+            snapshot_path.unlink()
+            print(f'step {step:,}: valid_loss {metrics["valid_loss"]:.4f} '
+                  f'auc {metrics["auc"]:.4f}')
+            json_log_plots.write_event(run_root, step=step, **metrics)
+            results.put((step, None))
+    except Exception:
+        results.put((step, traceback.format_exc()))
+    results.put(None)
 
 
-def get_loss(pred, targets, loss_weight):
+def best_logged_auc(run_root: Path, max_step: int) -> float:
+    """ Return best validation AUC logged up to ``max_step``.
+    """
+    log_path = run_root / 'json-log-plots.log'
+    best_auc = 0
+    if log_path.exists():
+        for line in log_path.read_text().splitlines():
+            event = json.loads(line)
+            if 'auc' in event and event['step'] <= max_step:
+                best_auc = max(best_auc, event['auc'])
+    return best_auc
+
+
+class CheckpointWriter:
+    """ Writes checkpoints in a background thread, in submission order.
+
+    Tensors are copied to CPU before ``save`` returns, so training can
+    continue updating them while the copy is serialized.
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def save(self, *items):
+        """ Save ``(obj, path)`` pairs, replacing files only after all
+        of them are written.
+        """
+        return self.then(_save_all, [(to_cpu(obj), path)
+                                     for obj, path in items])
+
+    def link(self, src: Path, dst: Path):
+        return self.then(link_file, src, dst)
+
+    def then(self, fn, *args, **kwargs):
+        """ Run ``fn`` after all previously submitted writes.
+        """
+        self._check()
+        future = self.executor.submit(fn, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def _check(self):
+        done = [f for f in self.futures if f.done()]
+        self.futures = [f for f in self.futures if not f.done()]
+        for future in done:
+            future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self._check()
+
+
+def to_cpu(obj):
+    """ Copy all tensors in a nested structure to CPU.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def _save_all(items):
+    """ Save ``(obj, path)`` pairs so that paths are never left
+    half-written, and files hard linked to old paths are not modified.
+    """
+    tmp_paths = []
+    for obj, path in items:
+        tmp = path.with_name(path.name + '.tmp')
+        torch.save(obj, tmp)
+        tmp_paths.append(tmp)
+    for tmp, (_, path) in zip(tmp_paths, items):
+        os.replace(str(tmp), str(path))
+
+
+def link_file(src: Path, dst: Path):
+    """ Atomically make ``dst`` a hard link to ``src``.
+    """
+    tmp = dst.with_name(dst.name + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    os.link(str(src), str(tmp))
+    os.replace(str(tmp), str(dst))
+
+
+def load_tokenizer(model_name: str):
+    """ Return tokenizer and padding index for a model name or path.
+    """
+    if 'bert' in model_name:
+        tokenizer = TrieBertTokenizer.from_pretrained(
+            model_name, do_lower_case='uncased' in model_name)
+        pad_idx = 0
+        remap_path = Path(model_name) / VOCAB_REMAP_NAME
+        if remap_path.exists():
+            tokenizer.id_remap = np.load(remap_path)
+            pad_idx = int(tokenizer.id_remap[pad_idx])
+    elif 'gpt2' in model_name:
+        tokenizer = GPT2Tokenizer.from_pretrained(model_name)
+        tokenizer.set_special_tokens([GPT2_PAD])
+        pad_idx, = tokenizer.convert_tokens_to_ids([GPT2_PAD])
+    else:
+        raise ValueError(f'Unexpected model {model_name}')
+    return tokenizer, pad_idx
+
+
+def load_model(model_name: str, num_labels: int = NUM_LABELS,
+               early_exit_layers=None):
+    """ Create a classification model from a pre-trained model name
+    or an exported model path, with early exit heads after
+    ``early_exit_layers`` if they are given (BERT only).
+    """
+    if 'bert' in model_name:
+        model = BertForSequenceClassification.from_pretrained(
+            model_name, num_labels=num_labels)
+    elif 'gpt2' in model_name:
+        model = GPT2ClassificationHeadModel(model_name, num_labels=num_labels)
+        model.transformer.set_num_special_tokens(1)
+        if Path(model_name).exists():
+            # to also load linear layer weights
+            model.load_state_dict(
+                torch.load(Path(model_name) / 'pytorch_model.bin',
+                           map_location='cpu'))
+    else:
+        raise ValueError(f'Unexpected model {model_name}')
+    if early_exit_layers:
+        if not isinstance(model, BertForSequenceClassification):
+            raise ValueError('Early exit is supported only for BERT')
+        model = EarlyExitBert(model, early_exit_layers, num_labels=num_labels)
+        if Path(model_name).exists():
+            state = torch.load(Path(model_name) / WEIGHTS_NAME,
+                               map_location='cpu')
+            if any(key.startswith('exit_classifiers.') for key in state):
+                model.load_state_dict(state)  # exported with early exit
+    return model
+
+
+def enable_activation_checkpointing(model, every: int = 1) -> int:
+    """ Checkpoint every ``every``-th encoder layer of the model,
+    returning number of checkpointed layers.
+    """
+    if isinstance(model, (BertForSequenceClassification, EarlyExitBert)):
+        layers = model.bert.encoder.layer
+    elif isinstance(model, GPT2ClassificationHeadModel):
+        layers = model.transformer.h
+    else:
+        raise ValueError(f'Unexpected model {type(model)}')
+    return checkpoint_layers(layers, every)
+
+
+def get_loss(pred, targets, loss_weight, aux_weight: float = 1.):
+    if pred.dim() == 3:
+        # outputs of all heads of an early exit model
+        return torch.stack([get_loss(p, targets, loss_weight, aux_weight)
+                            for p in pred]).mean()
     bce_loss_1 = F.binary_cross_entropy_with_logits(
         pred[:, :1], targets[:, :1], weight=targets[:, 1:2])
     bce_loss_2 = F.binary_cross_entropy_with_logits(pred[:, 1:], targets[:, 2:])
-    return (bce_loss_1 * loss_weight) + bce_loss_2
+    return (bce_loss_1 * loss_weight) + bce_loss_2 * aux_weight
 
 
 def validation(*, model, criterion, x_valid, y_valid, df_valid,
-               batch_size: int, bucket: bool, pad_idx: int):
-    valid_dataset = TensorDataset(
-        torch.tensor(x_valid, dtype=torch.long),
-        torch.tensor(y_valid, dtype=torch.float),
-    )
-    valid_loader = DataLoader(
-        valid_dataset, batch_size=batch_size, shuffle=False)
-
-    valid_preds, losses = [], []
-    model.eval()
-    for i, (x_batch, y_batch) in enumerate(
-            tqdm.tqdm(valid_loader, desc='validation', leave=False,
-                      disable=ON_KAGGLE)):
-        if bucket:
-            x_batch, y_batch = trim_tensors([x_batch, y_batch], pad_idx)
-        x_batch = x_batch.to(device)
-        y_batch = y_batch.to(device)
-        with torch.no_grad():
-            y_pred = model(x_batch, attention_mask=x_batch > 0, labels=None)
-            loss = criterion(y_pred, y_batch)
-        losses.append(float(loss.item()))
-        valid_preds.extend(y_pred[:, 0].cpu().squeeze().numpy())
-    model.train()
+               valid_texts: DedupedTexts, batch_size: int, bucket: bool,
+               pad_idx: int, precision: Precision = None):
+    """ Validate on ``x_valid`` which holds token ids
+    for ``valid_texts.texts``.
+    """
+    y_pred = torch.tensor(valid_texts.scatter(predict(
+        model, x_valid, batch_size=batch_size, pad_idx=pad_idx,
+        bucket=bucket, precision=precision, desc='validation')))
+    loss = criterion(y_pred, torch.tensor(y_valid, dtype=torch.float))
 
     df_valid = df_valid.copy()
-    df_valid['prediction'] = torch.sigmoid(torch.tensor(valid_preds)).numpy()
+    df_valid['prediction'] = torch.sigmoid(y_pred[:, 0]).numpy()
 
     metrics = compute_bias_metrics_for_model(df_valid, 'prediction')
-    metrics['valid_loss'] = np.mean(losses)
+    metrics['valid_loss'] = float(loss)
     return metrics, df_valid
 
 
 def train(
         *, model, criterion, x_train, y_train, epochs, yield_steps, bucket, lr,
-        batch_size: int, accumulation_steps: int, pad_idx: int,
+        batch_size: int, accumulation_steps: int, pad_idx: int, seed: int = 42,
+        precision: Precision = None, resume_state=None,
+        weight_average: 'WeightAverage' = None,
         ):
+    """ Train the model, yielding state every ``yield_steps``
+    and at the end of each epoch.
+
+    ``weight_average`` is updated after each optimizer step,
+    and saved in the training state.
+
+    The last element of the state is a dict with training position,
+    passing it back as ``resume_state`` together with optimizer state
+    continues training from that point.
+
+    Batches which run out of memory are split into micro-batches
+    with accumulated gradients, see ``AdaptiveBatchSize``. Out of memory
+    in backward leaves partially accumulated gradients, so then they are
+    cleared and all batches of the accumulation window are repeated.
+
+    If torch.distributed is initialized, the model is trained with
+    DistributedDataParallel, each process getting a part of the batches
+    of size ``batch_size``. Gradients are synchronized only once
+    per optimizer step.
+    """
     train_dataset = TensorDataset(
-        torch.tensor(x_train, dtype=torch.long),
-        torch.tensor(y_train, dtype=torch.float))
+        torch.as_tensor(x_train, dtype=torch.long),
+        torch.as_tensor(y_train, dtype=torch.float))
+    distributed = dist.is_available() and dist.is_initialized()
+    world_size = dist.get_world_size() if distributed else 1
+    verbose = not distributed or dist.get_rank() == 0
 
     model.zero_grad()
     model = model.to(device)
     param_optimizer = list(model.named_parameters())
 
     num_train_optimization_steps = int(
-        epochs * len(train_dataset) / (batch_size * accumulation_steps))
-    if isinstance(model, BertForSequenceClassification):
+        epochs * len(train_dataset) /
+        (batch_size * accumulation_steps * world_size))
+    if isinstance(model, (BertForSequenceClassification, EarlyExitBert)):
         no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
             {'params': [p for n, p in param_optimizer
@@ -321,97 +899,257 @@ def train(
     else:
         raise ValueError
 
-    model, optimizer = amp.initialize(
-        model, optimizer, opt_level='O1', verbosity=0)
+    precision = precision or Precision(device)
+    model, optimizer = precision.prepare(model, optimizer)
+    if distributed:
+        model = nn.parallel.DistributedDataParallel(model)
     model.train()
 
+    sampler = EpochRandomSampler(train_dataset, seed=seed)
     if bucket:
-        sampler = RandomSampler(train_dataset)
         batch_sampler = BucketBatchSampler(
             sampler, batch_size, drop_last=False, pad_idx=pad_idx)
-        train_loader = DataLoader(train_dataset, batch_sampler=batch_sampler)
     else:
-        train_loader = DataLoader(
-            train_dataset, batch_size=batch_size, shuffle=True)
+        batch_sampler = EpochBatchSampler(
+            sampler, batch_size, drop_last=False)
+    if distributed:
+        batch_sampler = DistributedBatchSampler(
+            batch_sampler, rank=dist.get_rank(), world_size=world_size)
+    train_loader = PrefetchLoader(
+        DataLoader(train_dataset, batch_sampler=batch_sampler),
+        device=device,
+        transform=partial(trim_tensors, pad_idx=pad_idx) if bucket else None)
 
     smoothed_loss = None
-    step = 0
-    epoch_pbar = tqdm.trange(epochs)
+    step = epoch = epoch_step = 0
+    batch_limits = AdaptiveBatchSize('train batch')
+    if resume_state is not None:
+        optimizer.load_state_dict(resume_state['optimizer'])
+        precision.load_state_dict(resume_state['precision'])
+        step = resume_state['train_step']
+        epoch = resume_state['epoch']
+        epoch_step = resume_state['epoch_step']
+        smoothed_loss = resume_state['smoothed_loss']
+        batch_limits.load_state_dict(resume_state.get('batch_limits', {}))
+        if weight_average is not None and 'weight_average' in resume_state:
+            weight_average.load_state_dict(resume_state['weight_average'])
+    # random state is reset after each checkpoint, just before the next
+    # batch, so that it does not depend on validation or on resuming
+    reseed_step = step
+    epoch_pbar = tqdm.tqdm(range(epoch, epochs), total=epochs, initial=epoch,
+                           disable=not verbose)
 
     def _state():
-        return model, optimizer, epoch_pbar, smoothed_loss, step * batch_size
-
-    print(f'Starting training for '
-          f'{num_train_optimization_steps * accumulation_steps:,} steps, '
-          f'checkpoint interval {yield_steps:,}')
+        if epoch_step == len(train_loader):
+            position = {'epoch': epoch + 1, 'epoch_step': 0}
+        else:
+            position = {'epoch': epoch, 'epoch_step': epoch_step}
+        train_state = dict(
+            position,
+            train_step=step,
+            smoothed_loss=smoothed_loss,
+            batch_limits=batch_limits.state_dict(),
+            precision=precision.state_dict())
+        if weight_average is not None:
+            train_state['weight_average'] = weight_average.state_dict()
+        return (model, optimizer, epoch_pbar, smoothed_loss,
+                step * batch_size * world_size, train_loader.mean_wait,
+                train_state)
+
+    if verbose:
+        print(f'Starting training for '
+              f'{num_train_optimization_steps * accumulation_steps:,} steps, '
+              f'checkpoint interval {yield_steps:,}')
+
+    def _train_micro_batch(tensors, weight, last, last_batch=True):
+        x_batch, y_batch = tensors
+        sync = last and last_batch and step % accumulation_steps == 0
+        with (model.no_sync() if distributed and not sync
+              else contextlib.suppress()):
+            with precision.autocast():
+                y_pred = model(x_batch, attention_mask=x_batch != pad_idx,
+                               labels=None)
+            loss = criterion(y_pred.float(), y_batch) * weight
+            try:
+                precision.backward(loss, optimizer)
+            except (RuntimeError, MemoryError) as e:
+                if not is_oom(e):
+                    raise
+                raise OutOfMemoryInUpdate(str(e)) from e
+        return loss.item()
+
+    # batches with gradients accumulated since the last optimizer step
+    window = []
+
+    def _accumulate(batches) -> float:
+        """ Accumulate gradients of ``batches``, the last of which is
+        the current batch, returning its loss.
+        """
+        while True:
+            try:
+                for i, batch in enumerate(batches):
+                    loss = sum(batch_limits.run(partial(
+                        _train_micro_batch,
+                        last_batch=i == len(batches) - 1), batch))
+                return loss
+            except OutOfMemoryInUpdate:
+                optimizer.zero_grad()
+                batches = window
+                print(f'Repeating {len(window)} batches of the '
+                      f'accumulation window after out of memory in backward')
 
     yield _state()
 
     torch.cuda.empty_cache()
-    for _ in epoch_pbar:
+    for epoch in epoch_pbar:
         optimizer.zero_grad()
-        pbar = tqdm.tqdm(train_loader, leave=False)
+        window.clear()
+        # already trained batches of a resumed epoch are not loaded
+        batch_sampler.set_epoch(epoch, skip=epoch_step)
+        pbar = tqdm.tqdm(train_loader,
+                         total=len(train_loader), initial=epoch_step,
+                         leave=False, disable=not verbose)
         for x_batch, y_batch in pbar:
+            if reseed_step is not None:
+                seed_everything(seed + reseed_step)
+                reseed_step = None
             step += 1
-            if bucket:
-                x_batch, y_batch = trim_tensors([x_batch, y_batch], pad_idx)
-            x_batch = x_batch.to(device)
-            y_batch = y_batch.to(device)
-            try:
-                y_pred = model(x_batch, attention_mask=x_batch > 0, labels=None)
-                loss = criterion(y_pred, y_batch)
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-                if step % accumulation_steps == 0:
-                    optimizer.step()
-                    optimizer.zero_grad()
-            except RuntimeError as e:
-                if 'CUDA out of memory' in str(e):
-                    print('ignoring', e)
-                    torch.cuda.empty_cache()
-                    continue
-                raise
+            epoch_step += 1
+            window.append([x_batch, y_batch])
+            loss = _accumulate(window[-1:])
+            if step % accumulation_steps == 0:
+                precision.step(optimizer)
+                optimizer.zero_grad()
+                window.clear()
+                if weight_average is not None:
+                    weight_average.update(model)
 
             if smoothed_loss is not None:
-                smoothed_loss = 0.98 * smoothed_loss + 0.02 * loss.item()
+                smoothed_loss = 0.98 * smoothed_loss + 0.02 * loss
             else:
-                smoothed_loss = loss.item()
-            pbar.set_postfix(loss=f'{smoothed_loss:.4f}')
+                smoothed_loss = loss
+            pbar.set_postfix(loss=f'{smoothed_loss:.4f}',
+                             wait=f'{train_loader.mean_wait * 1000:.1f}ms')
 
             if step % yield_steps == 0:
                 yield _state()
+                reseed_step = step
 
-        yield _state()
+        if step % yield_steps != 0:
+            yield _state()
+            reseed_step = step
+        epoch_step = 0
         torch.cuda.empty_cache()
 
 
-def tokenize_lines(texts, max_seq_length, tokenizer, use_bert: bool, pad_idx):
-    all_tokens = []
-    worker = partial(
-        tokenize, max_seq_length=max_seq_length, tokenizer=tokenizer,
-        use_bert=use_bert, pad_idx=pad_idx)
-    with multiprocessing.Pool(processes=4 if ON_KAGGLE else 16) as pool:
-        for tokens in tqdm.tqdm(pool.imap(worker, texts, chunksize=100),
-                                disable=ON_KAGGLE,
-                                total=len(texts), desc='tokenizing'):
-            all_tokens.append(tokens)
-    n_max_len = sum(t[-1] != 0 for t in all_tokens)
+def seed_everything(seed: int):
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    torch.manual_seed(seed)
+
+
+def tokenize_lines(texts, max_seq_length, tokenizer, use_bert: bool, pad_idx,
+                   pool: 'TokenizerPool' = None):
+    if pool is None:
+        with TokenizerPool(tokenizer, use_bert=use_bert,
+                           pad_idx=pad_idx) as pool:
+            return tokenize_lines(texts, max_seq_length, tokenizer,
+                                  use_bert=use_bert, pad_idx=pad_idx,
+                                  pool=pool)
+    all_tokens = pool.submit(list(texts), max_seq_length).get(
+        progress=not ON_KAGGLE)
+    n_max_len = np.sum(all_tokens[:, -1] != pad_idx)
     print(f'{n_max_len / len(texts):.1%} texts are '
           f'at least {max_seq_length} tokens long')
-    return np.array(all_tokens)
+    return all_tokens
+
+
+class TokenizerPool:
+    """ Long-lived pool of tokenization workers.
+
+    The tokenizer is sent to each worker once, and token ids come back
+    as tensors in shared memory. ``submit`` returns immediately, so
+    several jobs can be in flight while the model is busy.
+    """
+    def __init__(self, tokenizer, *, use_bert: bool, pad_idx: int,
+                 processes: int = None, min_block_size: int = 256):
+        self.processes = processes or (4 if ON_KAGGLE else 16)
+        self.min_block_size = min_block_size
+        self.pool = multiprocessing.Pool(
+            processes=self.processes,
+            initializer=_init_tokenizer_worker,
+            initargs=(tokenizer, use_bert, pad_idx))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, texts, max_seq_length: int) -> 'TokenizeJob':
+        # few large blocks keep the number of shared memory handles low
+        block_size = max(self.min_block_size,
+                         -(-len(texts) // (4 * self.processes)))
+        return TokenizeJob([
+            self.pool.apply_async(
+                _tokenize_block, (texts[i: i + block_size], max_seq_length))
+            for i in range(0, len(texts), block_size)],
+            max_seq_length=max_seq_length)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class TokenizeJob:
+    def __init__(self, results, max_seq_length: int):
+        self.results = results
+        self.max_seq_length = max_seq_length
+
+    def get(self, progress=False) -> np.ndarray:
+        results = self.results
+        if progress:
+            results = tqdm.tqdm(results, desc='tokenizing', leave=False)
+        blocks = [r.get().numpy() for r in results]
+        if not blocks:
+            return np.zeros((0, self.max_seq_length), dtype=np.int64)
+        return np.concatenate(blocks)
+
+
+_tokenizer_worker_state = None
+
+
+def _init_tokenizer_worker(tokenizer, use_bert: bool, pad_idx: int):
+    global _tokenizer_worker_state
+    _tokenizer_worker_state = dict(
+        tokenizer=tokenizer, use_bert=use_bert, pad_idx=pad_idx)
+
+
+def _tokenize_block(texts, max_seq_length: int) -> torch.Tensor:
+    tokens = [tokenize(text, max_seq_length, **_tokenizer_worker_state)
+              for text in texts]
+    # sent back via shared memory by torch.multiprocessing
+    return torch.tensor(tokens, dtype=torch.long)
 
 
 def tokenize(text, max_seq_length, tokenizer, use_bert: bool, pad_idx: int):
     trim_seq_length = max_seq_length
     if use_bert:
         trim_seq_length = max_seq_length - 2  # cls and sep
-    tokens_a = tokenizer.tokenize(text)
-    if len(tokens_a) > trim_seq_length:
-        tokens_a = tokens_a[:trim_seq_length]
-    if use_bert:
-        tokens_a = ['[CLS]'] + tokens_a + ['[SEP]']
-    return (tokenizer.convert_tokens_to_ids(tokens_a) +
-            [pad_idx] * (max_seq_length - len(tokens_a)))
+    if isinstance(tokenizer, TrieBertTokenizer):
+        ids = tokenizer.encode(text)[:trim_seq_length]
+        ids = [tokenizer.vocab['[CLS]']] + ids + [tokenizer.vocab['[SEP]']]
+    else:
+        tokens_a = tokenizer.tokenize(text)
+        if len(tokens_a) > trim_seq_length:
+            tokens_a = tokens_a[:trim_seq_length]
+        if use_bert:
+            tokens_a = ['[CLS]'] + tokens_a + ['[SEP]']
+        ids = tokenizer.convert_tokens_to_ids(tokens_a)
+    id_remap = getattr(tokenizer, 'id_remap', None)
+    if id_remap is not None:
+        ids = id_remap[ids].tolist()
+    return ids + [pad_idx] * (max_seq_length - len(ids))
 
 
 def preprocess_df(df: pd.DataFrame) -> pd.DataFrame:
@@ -450,47 +1188,168 @@ def get_target(df_train):
 
 
 def make_submission(*, model, tokenizer, run_root: Path, max_seq_length: int,
-                    batch_size: int, pad_idx, use_bert, bucket, test_size):
-    df = pd.read_csv(DATA_ROOT / 'test.csv')
-    if test_size and len(df) > test_size:
-        df = df.sample(n=test_size, random_state=42)
-    df = preprocess_df(df)
-    x_test = tokenize_lines(df.pop('comment_text'), max_seq_length, tokenizer,
-                            pad_idx=pad_idx, use_bert=use_bert)
-    if bucket:
-        indices, x_test = sorted_by_length(x_test, pad_idx)
-        df = df.iloc[indices]
+                    batch_size: int, pad_idx, use_bert, bucket, test_size,
+                    chunk_size: int, tokenizer_pool: TokenizerPool,
+                    precision: Precision = None,
+                    prediction_cache: PredictionCache = None,
+                    prefetch_chunks: int = 2):
+    """ Predict test.csv in chunks of ``chunk_size`` rows, so that memory
+    does not depend on the size of the input. Up to ``prefetch_chunks``
+    next chunks are tokenized while the model predicts the current one.
+    Duplicate and cached texts are predicted only once.
+    """
+    path = run_root / 'submission.csv'
+    pending = deque()
+    chunks = read_chunks(DATA_ROOT / 'test.csv', chunk_size=chunk_size,
+                         nrows=test_size)
+    with IdOrderedCsvWriter(path) as writer:
+        while True:
+            while len(pending) <= prefetch_chunks:
+                df = next(chunks, None)
+                if df is None:
+                    break
+                df = preprocess_df(df)
+                texts = DedupedTexts(
+                    df.pop('comment_text'), cache=prediction_cache,
+                    normalize=use_bert)
+                pending.append((df, texts, tokenizer_pool.submit(
+                    texts.texts, max_seq_length)))
+            if not pending:
+                break
+            df, texts, job = pending.popleft()
+            x_test = job.get()
+            y_pred = texts.scatter(predict(
+                model, x_test, batch_size=batch_size, pad_idx=pad_idx,
+                bucket=bucket, precision=precision))
+            df['prediction'] = torch.sigmoid(
+                torch.tensor(y_pred[:, 0])).numpy()
+            writer.write(df)
+    print(f'Saved submission to {path}')
 
-    test_dataset = TensorDataset(torch.tensor(x_test, dtype=torch.long))
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
 
-    test_preds = []
+# shared by validation and submission, as they use the same model
+PREDICT_BATCH_LIMITS = AdaptiveBatchSize('predict batch')
+
+
+def predict(model, x, *, batch_size: int, pad_idx: int, bucket: bool,
+            precision: Precision = None, desc='predict',
+            device: torch.device = None,
+            batch_limits: AdaptiveBatchSize = None) -> np.ndarray:
+    """ Return model outputs for token ids ``x`` in the original order.
+    With ``bucket``, texts are sorted by length to trim padding.
+    Batches are moved to ``device``, by default the device of the model.
+    Batches which run out of memory are split with ``batch_limits``,
+    by default shared by all predictions of this process.
+    """
+    if not len(x):
+        return np.zeros((0, NUM_LABELS), dtype=np.float32)
+    if device is None:
+        device = next(model.parameters()).device
+    batch_limits = batch_limits or PREDICT_BATCH_LIMITS
+    precision = precision or Precision(device)
+    if bucket:
+        indices, x = sorted_by_length(x, pad_idx)
+    loader = DataLoader(TensorDataset(torch.tensor(x, dtype=torch.long)),
+                        batch_size=batch_size, shuffle=False)
+    loader = PrefetchLoader(
+        loader, device=device,
+        transform=partial(trim_tensors, pad_idx=pad_idx) if bucket else None)
+    def _predict_micro_batch(tensors, *_):
+        x_batch, = tensors
+        with precision.autocast():
+            y_pred = model(
+                x_batch, attention_mask=x_batch != pad_idx, labels=None)
+        return y_pred.float().cpu().numpy()
+
+    preds = []
     model.eval()
-    for i, (x_batch, ) in enumerate(
-            tqdm.tqdm(test_loader, desc='submission', leave=False,
-                      disable=ON_KAGGLE)):
-        if bucket:
-            x_batch, = trim_tensors([x_batch], pad_idx)
-        x_batch = x_batch.to(device)
+    for x_batch, in tqdm.tqdm(loader, desc=desc, leave=False,
+                              disable=ON_KAGGLE):
         with torch.no_grad():
-            y_pred = model(x_batch, attention_mask=x_batch > 0, labels=None)
-        test_preds.extend(y_pred[:, 0].cpu().squeeze().numpy())
+            preds.extend(batch_limits.run(
+                _predict_micro_batch, [x_batch]))
     model.train()
+    preds = np.concatenate(preds)
+    if bucket:
+        unsorted = np.empty_like(preds)
+        unsorted[indices] = preds
+        preds = unsorted
+    return preds
 
-    df['prediction'] = torch.sigmoid(torch.tensor(test_preds)).numpy()
-    path = run_root / 'submission.csv'
-    df.sort_values('id', inplace=True)
-    df.to_csv(path, index=None)
-    print(f'Saved submission to {path}')
 
+class EpochRandomSampler(Sampler):
+    """ Random permutation which depends only on seed and epoch,
+    so that a resumed run sees samples in the same order.
+    """
+    def __init__(self, data_source, seed: int):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
 
-class BucketBatchSampler(BatchSampler):
+    def __iter__(self):
+        rng = np.random.RandomState([self.seed, self.epoch])
+        return iter(rng.permutation(len(self.data_source)).tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class EpochBatchSampler(BatchSampler):
+    """ Batches of a sampler which depends on the epoch, starting from
+    batch ``skip`` of the epoch, so that the DataLoader does not load
+    batches which a resumed run has already trained on.
+    Length is the number of batches in the whole epoch.
+    """
+    epoch = 0
+    skip = 0
+
+    def set_epoch(self, epoch: int, skip: int = 0):
+        self.epoch = epoch
+        self.skip = skip
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        return islice(self.batches(), self.skip, None)
+
+    def batches(self):
+        return super().__iter__()
+
+
+class DistributedBatchSampler:
+    """ Every ``world_size``-th batch of ``batch_sampler`` starting from
+    ``rank``: processes get disjoint batches, keeping length bucketing,
+    and the same number of them.
+    """
+    def __init__(self, batch_sampler, *, rank: int, world_size: int):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+        self.skip = 0
+
+    def set_epoch(self, epoch: int, skip: int = 0):
+        self.skip = skip
+        self.batch_sampler.set_epoch(epoch, skip=skip * self.world_size)
+
+    def __iter__(self):
+        return islice(self.batch_sampler, self.rank,
+                      (len(self) - self.skip) * self.world_size,
+                      self.world_size)
+
+    def __len__(self):
+        return len(self.batch_sampler) // self.world_size
+
+
+class BucketBatchSampler(EpochBatchSampler):
     def __init__(self, *args, pad_idx=None, **kwargs):
         assert pad_idx is not None
         super().__init__(*args, **kwargs)
         self.pad_idx = pad_idx
 
-    def __iter__(self):
+    def batches(self):
         k = 8
         buckets = defaultdict(list)
         lengths = (self.sampler.data_source.tensors[0] != self.pad_idx
@@ -498,7 +1357,8 @@ class BucketBatchSampler(BatchSampler):
         for idx in self.sampler:
             buckets[binned_length(lengths[idx], k)].append(idx)
 
-        rng = np.random.RandomState()
+        rng = np.random.RandomState(
+            [getattr(self.sampler, 'seed', 0), self.epoch])
         for i in range(len(self)):
             batch = []
             while len(batch) < self.batch_size:
@@ -540,13 +1400,18 @@ def trim_tensors(tsrs, pad_idx):
 def sorted_by_length(tokens, pad_idx):
     assert len(tokens.shape) == 2
     lengths = np.sum(tokens != pad_idx, axis=1)
-    indexed = sorted(enumerate(tokens), key=lambda x: lengths[x[0]])
-    indices = np.array([i for i, _ in indexed])
-    tokens = np.array([t for _, t in indexed])
-    return indices, tokens
+    indices = np.argsort(lengths, kind='mergesort')
+    return indices, tokens[indices]
 
 
 class GPT2ClassificationHeadModel(nn.Module):
+    """ Mean and max pooling of GPT-2 hidden states over positions
+    which are not masked by ``attention_mask``.
+
+    GPT-2 attention is causal, so trailing padding does not change hidden
+    states of real tokens and only has to be excluded from pooling,
+    which makes outputs independent of how much padding is trimmed.
+    """
     def __init__(self, model_name, num_labels: int, clf_dropout=0.2):
         super().__init__()
         self.transformer = GPT2Model.from_pretrained(model_name)
@@ -565,8 +1430,16 @@ class GPT2ClassificationHeadModel(nn.Module):
         hidden_states, _ = self.transformer(
             input_ids, position_ids, token_type_ids, past)
         last_hidden = hidden_states[-1]
-        avg_pool = torch.mean(last_hidden, 1)
-        max_pool, _ = torch.max(last_hidden, 1)
+        if attention_mask is None:
+            avg_pool = torch.mean(last_hidden, 1)
+            max_pool, _ = torch.max(last_hidden, 1)
+        else:
+            mask = attention_mask.unsqueeze(2).to(last_hidden.dtype)
+            lengths = mask.sum(1)
+            avg_pool = (last_hidden * mask).sum(1) / lengths.clamp(min=1)
+            max_pool, _ = last_hidden.masked_fill(mask == 0, -1e4).max(1)
+            # texts without tokens
+            max_pool = max_pool.masked_fill(lengths == 0, 0)
         h_conc = torch.cat((avg_pool, max_pool), 1)
         logits = self.linear(self.dropout(h_conc))
         return logits
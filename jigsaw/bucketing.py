@@ -0,0 +1,58 @@
+"""
+Prediction throughput in real (not padding) tokens per second,
+with and without length bucketing, for BERT and GPT-2 models::
+
+    python -m jigsaw.bucketing bert-base-uncased gpt2
+
+Outputs with and without bucketing should be the same, as padding
+is masked in both models.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+
+def main():
+    from .bert import device, load_model, load_tokenizer, predict
+
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('models', nargs='+')
+    arg('--n-texts', type=int, default=2000)
+    arg('--seq-length', type=int, default=296)
+    arg('--mean-length', type=int, default=60,
+        help='mean text length in tokens, lengths are geometric')
+    arg('--batch-size', type=int, default=64)
+    arg('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    lengths = np.clip(rng.geometric(1 / args.mean_length, args.n_texts),
+                      1, args.seq_length)
+    for model_name in args.models:
+        _, pad_idx = load_tokenizer(model_name)
+        x = rng.randint(1000, 2000, size=(args.n_texts, args.seq_length))
+        x[np.arange(args.seq_length) >= lengths[:, None]] = pad_idx
+        torch.manual_seed(args.seed)
+        model = load_model(model_name).to(device)
+        outputs = {}
+        for bucket in [False, True]:
+            predict(model, x[:args.batch_size], batch_size=args.batch_size,
+                    pad_idx=pad_idx, bucket=bucket)  # warmup
+            start = time.perf_counter()
+            outputs[bucket] = predict(
+                model, x, batch_size=args.batch_size, pad_idx=pad_idx,
+                bucket=bucket)
+            tokens_per_s = lengths.sum() / (time.perf_counter() - start)
+            print(f'{model_name} bucket={int(bucket)}: '
+                  f'{tokens_per_s:,.0f} tokens/s')
+        max_diff = np.abs(outputs[True] - outputs[False]).max()
+        print(f'{model_name}: max output difference from bucketing '
+              f'{max_diff:.2g}')
+        del model
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+"""
+Cascade inference: a cheap jigsaw.lstm model scores all comments, and only
+comments with scores inside an uncertainty band, or mentioning an identity,
+are scored by a jigsaw.bert model.
+
+Pick the band on BERT validation predictions, so that a target fraction
+of comments goes to BERT with the least loss of auc. Only validation rows
+which the LSTM was not trained on either are used::
+
+    python -m jigsaw.cascade calibrate _runs/cascade \\
+        --lstm _runs/lstm --bert _runs/example --bert-fraction 0.2
+
+Make a submission with the calibrated band (or an explicit ``--band``)::
+
+    python -m jigsaw.cascade submit _runs/cascade \\
+        --lstm _runs/lstm --bert _runs/example
+"""
+import argparse
+import json
+from pathlib import Path
+import re
+import time
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+
+from .bert import (
+    TokenizerPool, load_model, load_tokenizer, predict, preprocess_df,
+    tokenize_lines)
+from .lstm.main import load_run, predict_texts, split_rows
+from .metrics import compute_bias_metrics_for_model
+from .precision import get_precision
+from .streaming import IdOrderedCsvWriter, read_chunks
+from .utils import DATA_ROOT
+
+
+# words which are likely to mention one of metrics.IDENTITY_COLUMNS
+IDENTITY_TERMS = [
+    'male', 'female', 'man', 'men', 'woman', 'women', 'boy', 'girl',
+    'gay', 'lesbian', 'homosexual', 'bisexual', 'transgender', 'queer',
+    'lgbt', 'christian', 'catholic', 'jew', 'jewish', 'muslim', 'islam',
+    'islamic', 'black', 'white', 'mental', 'mentally', 'psychiatric',
+]
+_IDENTITY_RE = re.compile(
+    r'\b(?:{})s?\b'.format('|'.join(IDENTITY_TERMS)), re.IGNORECASE)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    arg = parser.add_argument
+    arg('action', choices=['calibrate', 'submit'])
+    arg('cascade_root')
+    arg('--lstm', required=True, help='jigsaw.lstm.main run path')
+    arg('--bert', required=True, help='jigsaw.bert run root')
+    arg('--model', default='bert-base-uncased')
+    arg('--seq-length', type=int, default=296)
+    arg('--batch-size', type=int, default=32)
+    arg('--bucket', type=int, default=1)
+    arg('--tokenize-workers', type=int)
+    arg('--lstm-batch-size', type=int, default=512)
+    arg('--lstm-workers', type=int, default=4)
+    arg('--no-identity-routing', action='store_true',
+        help='do not send comments which mention an identity to BERT')
+    # calibrate
+    arg('--bert-fraction', type=float, default=0.2,
+        help='target fraction of comments scored by BERT')
+    arg('--n-candidates', type=int, default=50,
+        help='band positions to evaluate')
+    # submit
+    arg('--band', type=float, nargs=2, metavar=('LOW', 'HIGH'),
+        help='LSTM score band, by default from calibrate, together with '
+             'its identity routing')
+    arg('--test-size', type=int)
+    arg('--chunk-size', type=int, default=20000)
+    args = parser.parse_args()
+
+    cascade_root = Path(args.cascade_root)
+    cascade_root.mkdir(exist_ok=True, parents=True)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    lstm_model, sp_model, lstm_params = load_run(args.lstm, device)
+
+    def _lstm_scores(texts) -> np.ndarray:
+        y_pred = predict_texts(
+            lstm_model, texts, sp_model=sp_model,
+            max_len=lstm_params['max_len'], batch_size=args.lstm_batch_size,
+            workers=args.lstm_workers, device=device)
+        return _sigmoid(y_pred[:, 0])
+
+    def _mentions(texts) -> np.ndarray:
+        if args.no_identity_routing:
+            return np.zeros(len(texts), dtype=bool)
+        return mentions_identity(texts)
+
+    if args.action == 'calibrate':
+        df_valid = pd.read_csv(Path(args.bert) / 'valid-predictions.csv')
+        df_train = _train_df()
+        # LSTM scores of its training rows would be overconfident
+        _, lstm_valid_rows = split_rows(df_train)
+        df_valid = df_valid[df_valid['id'].isin(
+            df_train['id'].values[lstm_valid_rows])]
+        print(f'{len(df_valid):,} validation rows are out-of-fold '
+              f'for both models')
+        if not len(df_valid):
+            parser.error('no BERT validation rows are out-of-fold '
+                         'for the LSTM')
+        texts = list(df_train.set_index('id').loc[
+            df_valid['id'].values, 'comment_text'])
+        bert_scores = df_valid.pop('prediction').values
+        lstm_scores = _lstm_scores(texts)
+        mentions = _mentions(texts)
+        print(f'{mentions.mean():.1%} of validation comments '
+              f'mention an identity')
+        auc, (low, high) = choose_band(
+            df_valid, lstm_scores, bert_scores, mentions,
+            bert_fraction=args.bert_fraction, n_candidates=args.n_candidates)
+        routed = cascade_route(lstm_scores, mentions, low, high)
+        band = {
+            'low': float(low), 'high': float(high),
+            'identity_routing': not args.no_identity_routing,
+            'bert_fraction': float(routed.mean()),
+            'auc': auc,
+            'lstm_auc': _auc(df_valid, lstm_scores),
+            'bert_auc': _auc(df_valid, bert_scores),
+        }
+        print(json.dumps(band, indent=4))
+        band_path = cascade_root / 'band.json'
+        band_path.write_text(json.dumps(band, indent=4))
+        print(f'Saved band to {band_path}')
+        return
+
+    if args.band:
+        low, high = args.band
+    else:
+        band = json.loads((cascade_root / 'band.json').read_text())
+        low, high = band['low'], band['high']
+        # the band is only valid with the routing it was calibrated for
+        if band['identity_routing']:
+            if args.no_identity_routing:
+                parser.error('band.json was calibrated with identity '
+                             'routing, remove --no-identity-routing or '
+                             'pass --band')
+        else:
+            args.no_identity_routing = True
+    tokenizer, pad_idx = load_tokenizer(args.model)
+    tokenizer_pool = TokenizerPool(
+        tokenizer, use_bert='bert' in args.model, pad_idx=pad_idx,
+        processes=args.tokenize_workers)
+    bert_model = load_model(args.model)
+    if not Path(args.model).exists():
+        bert_model.load_state_dict(torch.load(
+            Path(args.bert) / 'model-best.pt', map_location='cpu'))
+    precision = get_precision(None, device)
+    bert_model, _ = precision.prepare(bert_model.to(device))
+
+    n_total = n_routed = 0
+    times = {'lstm': 0., 'bert': 0.}
+    path = cascade_root / 'submission.csv'
+    with IdOrderedCsvWriter(path) as writer:
+        for df in read_chunks(DATA_ROOT / 'test.csv',
+                              chunk_size=args.chunk_size,
+                              nrows=args.test_size):
+            texts = list(preprocess_df(df).pop('comment_text'))
+            start = time.perf_counter()
+            scores = _lstm_scores(texts)
+            times['lstm'] += time.perf_counter() - start
+            routed = cascade_route(scores, _mentions(texts), low, high)
+            start = time.perf_counter()
+            x = tokenize_lines(
+                [t for t, r in zip(texts, routed) if r], args.seq_length,
+                tokenizer, use_bert='bert' in args.model, pad_idx=pad_idx,
+                pool=tokenizer_pool)
+            y_pred = predict(bert_model, x, batch_size=args.batch_size,
+                             pad_idx=pad_idx, bucket=args.bucket,
+                             precision=precision)
+            scores[routed] = _sigmoid(y_pred[:, 0])
+            times['bert'] += time.perf_counter() - start
+            df['prediction'] = scores
+            writer.write(df[['id', 'prediction']])
+            n_total += len(df)
+            n_routed += int(routed.sum())
+    tokenizer_pool.close()
+    print(f'{n_routed / max(1, n_total):.1%} of {n_total:,} comments '
+          f'scored by BERT, '
+          f'LSTM {times["lstm"]:.1f} s, BERT {times["bert"]:.1f} s')
+    print(f'Saved submission to {path}')
+
+
+def mentions_identity(texts) -> np.ndarray:
+    return np.array([_IDENTITY_RE.search(text) is not None
+                     for text in texts], dtype=bool)
+
+
+def cascade_route(lstm_scores: np.ndarray, mentions: np.ndarray,
+                  low: float, high: float) -> np.ndarray:
+    """ Mask of comments which are scored by BERT.
+    """
+    return mentions | ((lstm_scores >= low) & (lstm_scores <= high))
+
+
+def choose_band(df: pd.DataFrame, lstm_scores: np.ndarray,
+                bert_scores: np.ndarray, mentions: np.ndarray, *,
+                bert_fraction: float,
+                n_candidates: int) -> Tuple[float, Tuple[float, float]]:
+    """ Return the best auc of cascade scores and the (low, high) band
+    of LSTM scores which gives it. All bands hold the same number of
+    comments which do not mention an identity, so that together with
+    the ones which do, ``bert_fraction`` of comments is sent to BERT.
+    """
+    others = np.sort(lstm_scores[~mentions])
+    n_band = min(len(others),
+                 int(round(bert_fraction * len(df))) - int(mentions.sum()))
+    if n_band <= 0:
+        print('Comments mentioning an identity already exceed '
+              'the target fraction')
+        candidates = [(1., 0.)]  # empty band
+    else:
+        candidates = [
+            (others[start], others[start + n_band - 1])
+            for start in np.unique(np.linspace(
+                0, len(others) - n_band, n_candidates).astype(int))]
+    best = None
+    for low, high in candidates:
+        routed = cascade_route(lstm_scores, mentions, low, high)
+        auc = _auc(df, np.where(routed, bert_scores, lstm_scores))
+        if best is None or auc > best[0]:
+            best = (auc, (low, high))
+    return best
+
+
+def _train_df() -> pd.DataFrame:
+    train_pkl_path = DATA_ROOT / 'train.pkl'
+    if not train_pkl_path.exists():
+        pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
+    return preprocess_df(pd.read_pickle(train_pkl_path))
+
+
+def _auc(df: pd.DataFrame, scores: np.ndarray) -> float:
+    return compute_bias_metrics_for_model(
+        df.assign(prediction=scores), 'prediction')['auc']
+
+
+def _sigmoid(x: np.ndarray) -> np.ndarray:
+    return torch.sigmoid(torch.from_numpy(x)).numpy()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+Compact builds of a model exported with ``jigsaw.bert --export``:
+top encoder layers are dropped (optionally followed by a short re-tune),
+and word embeddings are trimmed to token ids which appear in train and test
+texts. Token ids are remapped to the trimmed embeddings in ``tokenize``.
+
+Build variants and compare their size, load time, CPU latency and
+validation auc::
+
+    python -m jigsaw.compact _runs/example/bert-uncased-export _runs/compact \\
+        --drop-layers 0 2 4 --trim-vocab
+
+Variants are saved as ``_runs/compact/bert-uncased-export-layersN[-vocab]``
+and can be used as ``--model`` of ``jigsaw.bert`` and ``jigsaw.serve``.
+"""
+import argparse
+import json
+from pathlib import Path
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+from pytorch_pretrained_bert import CONFIG_NAME, WEIGHTS_NAME
+
+from .bert import (
+    VOCAB_REMAP_NAME, TokenizerPool, device, get_loss, get_target,
+    load_model, load_tokenizer, predict, preprocess_df, train)
+from .metrics import compute_bias_metrics_for_model
+from .utils import DATA_ROOT
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    arg = parser.add_argument
+    arg('export_path')
+    arg('output_root')
+    arg('--drop-layers', type=int, nargs='+', default=[0, 2, 4],
+        help='numbers of top encoder layers to drop, one variant each')
+    arg('--trim-vocab', action='store_true',
+        help='keep only embeddings of token ids used in train and test')
+    arg('--retune-samples', type=int, default=0,
+        help='train variants with dropped layers on this many samples')
+    arg('--retune-lr', type=float, default=1e-5)
+    arg('--seq-length', type=int, default=296)
+    arg('--batch-size', type=int, default=32)
+    arg('--valid-size', type=int, default=5000)
+    arg('--latency-texts', type=int, default=200)
+    arg('--threads', type=int, default=1, help='CPU threads for latency')
+    arg('--fold', type=int, default=0)
+    arg('--folds', help='by default data/folds.json')
+    arg('--tokenize-workers', type=int)
+    args = parser.parse_args()
+
+    export_path = Path(args.export_path)
+    output_root = Path(args.output_root)
+    output_root.mkdir(exist_ok=True, parents=True)
+
+    train_pkl_path = DATA_ROOT / 'train.pkl'
+    if not train_pkl_path.exists():
+        pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
+    df = preprocess_df(pd.read_pickle(train_pkl_path))
+    folds_path = Path(args.folds) if args.folds else DATA_ROOT / 'folds.json'
+    valid_index = df['id'].isin(json.loads(folds_path.read_text())[args.fold])
+    df_train, df_valid = df[~valid_index], df[valid_index]
+    if len(df_valid) > args.valid_size:
+        df_valid = df_valid.sample(n=args.valid_size, random_state=42)
+
+    kept_ids = None
+    if args.trim_vocab:
+        texts = list(df['comment_text']) + list(preprocess_df(
+            pd.read_csv(DATA_ROOT / 'test.csv'))['comment_text'])
+        kept_ids = used_token_ids(export_path, texts, args)
+        print(f'{len(kept_ids):,} token ids are used')
+
+    results = [evaluate(export_path, df_valid, args)]
+    for drop_layers in args.drop_layers:
+        name = f'{export_path.name}-layers{drop_layers}'
+        if kept_ids is not None:
+            name += '-vocab'
+        elif not drop_layers:
+            continue  # same as the original
+        variant_path = output_root / name
+        build_variant(export_path, variant_path,
+                      drop_layers=drop_layers, kept_ids=kept_ids)
+        if drop_layers and args.retune_samples:
+            retune(variant_path, df_train.sample(
+                n=min(len(df_train), args.retune_samples), random_state=42),
+                args)
+        results.append(evaluate(variant_path, df_valid, args))
+
+    for result in results:
+        print(f'{result["name"]:<40} layers {result["layers"]:>2} '
+              f'vocab {result["vocab"]:>6,} {result["size_mb"]:>7.1f} MB '
+              f'load {result["load_s"]:.2f} s '
+              f'latency {result["latency_ms"]:.1f} ms '
+              f'auc {result["auc"]:.4f}')
+    (output_root / 'results.json').write_text(json.dumps(results, indent=4))
+
+
+def used_token_ids(export_path: Path, texts, args) -> np.ndarray:
+    """ Sorted token ids which appear in ``texts``, and special tokens.
+    """
+    tokenizer, pad_idx = load_tokenizer(str(export_path))
+    config = json.loads((export_path / CONFIG_NAME).read_text())
+    used = np.zeros(config['vocab_size'], dtype=bool)
+    special = tokenizer.convert_tokens_to_ids(
+        ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'])
+    id_remap = getattr(tokenizer, 'id_remap', None)
+    used[special if id_remap is None else id_remap[special]] = True
+    chunk_size = 100000  # all token ids of the corpus do not fit in memory
+    with TokenizerPool(tokenizer, use_bert=True, pad_idx=pad_idx,
+                       processes=args.tokenize_workers) as pool:
+        for i in range(0, len(texts), chunk_size):
+            used[pool.submit(texts[i: i + chunk_size],
+                             args.seq_length).get(progress=True)] = True
+    return np.nonzero(used)[0]
+
+
+def build_variant(export_path: Path, variant_path: Path, *,
+                  drop_layers: int, kept_ids: np.ndarray = None):
+    config = json.loads((export_path / CONFIG_NAME).read_text())
+    state = torch.load(export_path / WEIGHTS_NAME, map_location='cpu')
+    n_layers = config['num_hidden_layers'] - drop_layers
+    prefix = 'bert.encoder.layer.'
+    state = {key: value for key, value in state.items()
+             if not (key.startswith(prefix) and
+                     int(key[len(prefix):].split('.')[0]) >= n_layers)}
+    config['num_hidden_layers'] = n_layers
+    variant_path.mkdir(exist_ok=True, parents=True)
+    shutil.copy(str(export_path / 'vocab.txt'), str(variant_path))
+    id_remap_path = export_path / VOCAB_REMAP_NAME
+    id_remap = np.load(id_remap_path) if id_remap_path.exists() else None
+    if kept_ids is not None:
+        key = 'bert.embeddings.word_embeddings.weight'
+        state[key] = state[key][torch.from_numpy(kept_ids)].clone()
+        tokenizer, _ = load_tokenizer(str(export_path))
+        unk_id = tokenizer.vocab['[UNK]']
+        if id_remap is None:
+            id_remap = np.arange(config['vocab_size'])
+        else:
+            unk_id = id_remap[unk_id]
+        # rows of kept ids in the trimmed matrix, unknown for the rest
+        rows = np.full(config['vocab_size'], np.searchsorted(kept_ids, unk_id))
+        rows[kept_ids] = np.arange(len(kept_ids))
+        id_remap = rows[id_remap]
+        config['vocab_size'] = len(kept_ids)
+    if id_remap is not None:
+        np.save(variant_path / VOCAB_REMAP_NAME, id_remap)
+    (variant_path / CONFIG_NAME).write_text(json.dumps(config, indent=2))
+    torch.save(state, variant_path / WEIGHTS_NAME)
+
+
+def retune(variant_path: Path, df_train: pd.DataFrame, args):
+    print(f'Re-tuning {variant_path.name} on {len(df_train):,} samples')
+    tokenizer, pad_idx = load_tokenizer(str(variant_path))
+    model = load_model(str(variant_path)).to(device)
+    with TokenizerPool(tokenizer, use_bert=True, pad_idx=pad_idx,
+                       processes=args.tokenize_workers) as pool:
+        x_train = pool.submit(list(df_train['comment_text']),
+                              args.seq_length).get(progress=True)
+    y_train, loss_weight = get_target(df_train)
+    for _ in train(model=model,
+                   criterion=lambda y_pred, y: get_loss(
+                       y_pred, y, loss_weight=loss_weight),
+                   x_train=x_train, y_train=y_train, epochs=1,
+                   yield_steps=len(x_train), bucket=True, lr=args.retune_lr,
+                   batch_size=args.batch_size, accumulation_steps=1,
+                   pad_idx=pad_idx):
+        pass
+    torch.save(model.state_dict(), variant_path / WEIGHTS_NAME)
+
+
+def evaluate(model_path: Path, df_valid: pd.DataFrame, args):
+    """ Size, load time, CPU latency of single texts and validation auc.
+    """
+    start = time.perf_counter()
+    tokenizer, pad_idx = load_tokenizer(str(model_path))
+    model = load_model(str(model_path))
+    load_s = time.perf_counter() - start
+    with TokenizerPool(tokenizer, use_bert=True, pad_idx=pad_idx,
+                       processes=args.tokenize_workers) as pool:
+        x_valid = pool.submit(list(df_valid['comment_text']),
+                              args.seq_length).get()
+    y_pred = predict(model.to(device), x_valid, batch_size=args.batch_size,
+                     pad_idx=pad_idx, bucket=True)
+    df_valid = df_valid.drop(columns=['comment_text'])
+    df_valid['prediction'] = torch.sigmoid(
+        torch.from_numpy(y_pred[:, 0])).numpy()
+    metrics = compute_bias_metrics_for_model(df_valid, 'prediction')
+
+    model = model.cpu().eval()
+    n_threads = torch.get_num_threads()
+    torch.set_num_threads(args.threads)
+    latencies = []
+    with torch.no_grad():
+        for ids in x_valid[:args.latency_texts]:
+            x = torch.from_numpy(ids[ids != pad_idx][None])
+            start = time.perf_counter()
+            model(x, attention_mask=x != pad_idx, labels=None)
+            latencies.append(time.perf_counter() - start)
+    torch.set_num_threads(n_threads)
+    config = json.loads((model_path / CONFIG_NAME).read_text())
+    return {
+        'name': model_path.name,
+        'layers': config['num_hidden_layers'],
+        'vocab': config['vocab_size'],
+        'size_mb': (model_path / WEIGHTS_NAME).stat().st_size / 2 ** 20,
+        'load_s': load_s,
+        'latency_ms': 1000 * float(np.median(latencies)),
+        'auc': metrics['auc'],
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Early exit BERT: classification heads after selected encoder layers,
+trained jointly with the final head. At inference with a threshold,
+a text stops at the first head which is confident enough, so easy texts
+run only through the first layers.
+
+Train with heads after layers 4 and 8::
+
+    python -m jigsaw.bert _runs/early-exit --early-exit-layers 4 8
+
+and compare auc, mean number of layers and throughput for thresholds
+on validation predictions of the run::
+
+    python -m jigsaw.early_exit _runs/early-exit --thresholds 0.9 0.95 0.99
+"""
+import argparse
+import json
+from pathlib import Path
+import time
+from typing import List
+
+import pandas as pd
+import torch
+from torch import nn
+
+
+class EarlyExitBert(nn.Module):
+    """ Wraps ``BertForSequenceClassification``, keeping its parameter names,
+    so that its weights can be loaded with ``strict=False``.
+
+    In training mode, outputs of all heads are stacked along the first
+    dimension. In eval mode, outputs of the final head are returned
+    if ``threshold`` is None, else each text gets the output of the first
+    head where the toxicity probability is at least ``threshold``
+    or at most ``1 - threshold``. Texts which exited are removed from the
+    batch and padding is trimmed again, so remaining texts are batched
+    together.
+    """
+    def __init__(self, model, exit_layers: List[int], num_labels: int):
+        super().__init__()
+        self.bert = model.bert
+        self.dropout = model.dropout
+        self.classifier = model.classifier
+        n_layers = len(self.bert.encoder.layer)
+        assert all(0 < layer < n_layers for layer in exit_layers)
+        self.exit_layers = sorted(exit_layers)
+        hidden_size = self.bert.config.hidden_size
+        self.exit_classifiers = nn.ModuleList([
+            nn.Sequential(
+                nn.Linear(hidden_size, hidden_size), nn.Tanh(),
+                nn.Dropout(self.bert.config.hidden_dropout_prob),
+                nn.Linear(hidden_size, num_labels))
+            for _ in self.exit_layers])
+        self.threshold = None
+        self.reset_stats()
+
+    @property
+    def config(self):
+        return self.bert.config
+
+    def reset_stats(self):
+        self.n_texts = 0
+        self.n_text_layers = 0
+
+    @property
+    def mean_layers(self) -> float:
+        return self.n_text_layers / max(1, self.n_texts)
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None,
+                labels=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        hidden = self.bert.embeddings(input_ids, token_type_ids)
+        exits = dict(zip(self.exit_layers, self.exit_classifiers))
+        early_exit = not self.training and self.threshold is not None
+        outputs = []
+        active = torch.arange(len(input_ids), device=input_ids.device)
+        for i, layer in enumerate(self.bert.encoder.layer, 1):
+            hidden = layer(hidden, _extended_mask(attention_mask, hidden))
+            if not early_exit:
+                if i in exits:
+                    outputs.append(exits[i](hidden[:, 0]))
+                continue
+            self.n_text_layers += len(active)
+            if i not in exits:
+                continue
+            y_pred = exits[i](hidden[:, 0]).float()
+            if not outputs:
+                outputs.append(y_pred.new_zeros(
+                    (len(input_ids), y_pred.shape[1])))
+            prob = torch.sigmoid(y_pred[:, 0])
+            done = (prob >= self.threshold) | (prob <= 1 - self.threshold)
+            outputs[0][active[done]] = y_pred[done]
+            keep = ~done
+            active = active[keep]
+            if not len(active):
+                break
+            attention_mask = attention_mask[keep]
+            length = int(attention_mask.sum(1).max())
+            hidden = hidden[keep, :length]
+            attention_mask = attention_mask[:, :length]
+        if early_exit:
+            self.n_texts += len(input_ids)
+            if len(active):
+                outputs[0][active] = self._final_output(hidden).float()
+            return outputs[0]
+        final_output = self._final_output(hidden)
+        if not self.training:
+            return final_output
+        return torch.stack(outputs + [final_output])
+
+    def _final_output(self, hidden):
+        return self.classifier(self.dropout(self.bert.pooler(hidden)))
+
+
+def _extended_mask(attention_mask, hidden):
+    mask = attention_mask[:, None, None, :].to(hidden.dtype)
+    return (1.0 - mask) * -10000.0
+
+
+def main():
+    """ Predict validation texts of a run with each exit threshold,
+    reporting auc, mean number of layers and throughput.
+    """
+    from .bert import (
+        device, load_model, load_tokenizer, predict, preprocess_df,
+        tokenize_lines)
+    from .metrics import compute_bias_metrics_for_model
+    from .precision import get_precision
+    from .utils import DATA_ROOT
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    arg = parser.add_argument
+    arg('run_root')
+    arg('--thresholds', type=float, nargs='+',
+        default=[0.8, 0.9, 0.95, 0.99])
+    arg('--batch-size', type=int, default=32)
+    arg('--precision')
+    arg('--tokenize-workers', type=int)
+    args = parser.parse_args()
+
+    run_root = Path(args.run_root)
+    params = json.loads((run_root / 'params.json').read_text())
+    if not params.get('early_exit_layers'):
+        parser.error(f'{run_root} was trained without --early-exit-layers')
+    df_valid = pd.read_csv(run_root / 'valid-predictions.csv')
+    df_train = preprocess_df(pd.read_pickle(DATA_ROOT / 'train.pkl'))
+    texts = df_train.set_index('id').loc[df_valid['id'], 'comment_text']
+    tokenizer, pad_idx = load_tokenizer(params['model'])
+    x = tokenize_lines(
+        list(texts), params['test_seq_length'], tokenizer,
+        use_bert=True, pad_idx=pad_idx)
+    model = load_model(params['model'],
+                       early_exit_layers=params['early_exit_layers'])
+    model.load_state_dict(torch.load(
+        run_root / 'model-best.pt', map_location='cpu'))
+    precision = get_precision(args.precision, device)
+    model, _ = precision.prepare(model.to(device))
+    n_layers = len(model.bert.encoder.layer)
+
+    baseline_time = None
+    for threshold in [None] + args.thresholds:
+        model.threshold = threshold
+        model.reset_stats()
+        start = time.perf_counter()
+        y_pred = predict(model, x, batch_size=args.batch_size,
+                         pad_idx=pad_idx, bucket=True, precision=precision)
+        elapsed = time.perf_counter() - start
+        baseline_time = baseline_time or elapsed
+        df_valid['prediction'] = torch.sigmoid(
+            torch.from_numpy(y_pred[:, 0])).numpy()
+        auc = compute_bias_metrics_for_model(df_valid, 'prediction')['auc']
+        mean_layers = model.mean_layers if threshold else n_layers
+        print(f'threshold {threshold or "-":<5} auc {auc:.4f} '
+              f'layers {mean_layers:.2f} / {n_layers} '
+              f'{len(x) / elapsed:,.0f} texts/s '
+              f'speedup {baseline_time / elapsed:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Blended predictions of several models exported with ``jigsaw.bert --export``
+for test.csv, without intermediate submissions: test.csv is read once
+in chunks, each chunk is tokenized once per vocabulary, and models run
+in parallel on ``--devices`` (one model at a time per device)::
+
+    python -m jigsaw.ensemble _runs/ensemble-submission.csv \\
+        _runs/a/bert-uncased-export _runs/b/bert-uncased-export \\
+        _runs/c/gpt2-export --weights 2,1,1 --devices cuda:0 cuda:1
+
+Predictions are averaged with weights, as in ``jigsaw.blend``.
+"""
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import time
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from .bert import (
+    VOCAB_REMAP_NAME, TokenizerPool, load_model, load_tokenizer, predict,
+    preprocess_df)
+from .oom import AdaptiveBatchSize
+from .precision import PRECISIONS, get_precision
+from .prediction_cache import DedupedTexts
+from .streaming import IdOrderedCsvWriter, read_chunks
+from .utils import DATA_ROOT
+
+
+# files which define token ids of an exported model
+TOKENIZER_FILES = [
+    'vocab.txt', 'vocab.json', 'merges.txt', 'special_tokens.txt',
+    VOCAB_REMAP_NAME]
+
+
+class EnsembleMember:
+    def __init__(self, path: str, weight: float, device: torch.device,
+                 precision_name: str):
+        self.path = path
+        self.weight = weight
+        self.device = device
+        self.tokenizer_key = tokenizer_key(path)
+        self.precision = get_precision(precision_name, device)
+        # out of memory of one model or device does not limit the others
+        self.batch_limits = AdaptiveBatchSize(f'{Path(path).name} batch')
+        self.model = None
+        self.pad_idx = None
+        self.seconds = 0.
+
+    def load(self):
+        model = load_model(self.path).to(self.device)
+        self.model, _ = self.precision.prepare(model)
+
+    def predict(self, x, *, batch_size: int, bucket: bool) -> np.ndarray:
+        start = time.perf_counter()
+        y_pred = predict(self.model, x, batch_size=batch_size,
+                         pad_idx=self.pad_idx, bucket=bucket,
+                         precision=self.precision, device=self.device,
+                         batch_limits=self.batch_limits,
+                         desc=Path(self.path).name)
+        self.seconds += time.perf_counter() - start
+        return y_pred
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    arg = parser.add_argument
+    arg('output')
+    arg('models', nargs='+', help='exported model paths')
+    arg('--weights', help='comma separated, equal by default')
+    arg('--devices', nargs='+',
+        help='by default all GPUs, or CPU if there are none')
+    # apex can be initialized only once per process
+    arg('--precision', choices=[p for p in PRECISIONS if p != 'apex'],
+        help='by default fp16 on CUDA and fp32 on CPU')
+    arg('--seq-length', type=int, default=296)
+    arg('--batch-size', type=int, default=32)
+    arg('--bucket', type=int, default=1)
+    arg('--chunk-size', type=int, default=20000)
+    arg('--prefetch-chunks', type=int, default=2)
+    arg('--test-size', type=int)
+    arg('--tokenize-workers', type=int,
+        help='tokenization processes of all vocabularies together')
+    args = parser.parse_args()
+
+    for path in args.models:
+        if not Path(path).exists():
+            parser.error(f'{path} is not an exported model')
+    if args.weights:
+        weights = list(map(float, args.weights.split(',')))
+        if len(weights) != len(args.models):
+            parser.error('expected one weight per model')
+    else:
+        weights = [1.] * len(args.models)
+    if args.devices:
+        devices = [torch.device(d) for d in args.devices]
+    elif torch.cuda.is_available():
+        devices = [torch.device('cuda', i)
+                   for i in range(torch.cuda.device_count())]
+    else:
+        devices = [torch.device('cpu')]
+
+    members = [
+        EnsembleMember(
+            path, weight, device=devices[i % len(devices)],
+            precision_name=args.precision or (
+                'fp16' if devices[i % len(devices)].type == 'cuda'
+                else 'fp32'))
+        for i, (path, weight) in enumerate(zip(args.models, weights))]
+    groups: Dict[str, List[EnsembleMember]] = OrderedDict()
+    for member in members:
+        groups.setdefault(member.tokenizer_key, []).append(member)
+    processes = max(1, (args.tokenize_workers or os.cpu_count()) //
+                    len(groups))
+    pools = OrderedDict()
+    for key, group in groups.items():
+        tokenizer, pad_idx = load_tokenizer(group[0].path)
+        # start workers before models are loaded and moved to devices
+        pools[key] = TokenizerPool(
+            tokenizer, use_bert='bert' in group[0].path, pad_idx=pad_idx,
+            processes=processes)
+        for member in group:
+            member.pad_idx = pad_idx
+        print(f'Vocabulary {len(pools)}: '
+              f'{", ".join(member.path for member in group)}')
+    for member in members:
+        print(f'Loading {member.path} on {member.device}')
+        member.load()
+
+    by_device = OrderedDict()
+    for member in members:
+        by_device.setdefault(member.device, []).append(member)
+
+    def _predict_on_device(device_members, tokens) -> Dict[int, np.ndarray]:
+        return {id(member): member.predict(
+                    tokens[member.tokenizer_key], batch_size=args.batch_size,
+                    bucket=args.bucket)
+                for member in device_members}
+
+    # GPT-2 tokens keep spaces, so its texts are deduplicated as they are
+    normalize = all('bert' in member.path for member in members)
+    start = time.perf_counter()
+    n_texts = 0
+    total_weight = sum(weights)
+    pending = deque()
+    chunks = read_chunks(DATA_ROOT / 'test.csv', chunk_size=args.chunk_size,
+                         nrows=args.test_size)
+    with ThreadPoolExecutor(max_workers=len(by_device)) as executor, \
+            IdOrderedCsvWriter(Path(args.output)) as writer:
+        while True:
+            while len(pending) <= args.prefetch_chunks:
+                df = next(chunks, None)
+                if df is None:
+                    break
+                df = preprocess_df(df)
+                texts = DedupedTexts(df.pop('comment_text'),
+                                     normalize=normalize)
+                pending.append((df, texts, OrderedDict(
+                    (key, pool.submit(texts.texts, args.seq_length))
+                    for key, pool in pools.items())))
+            if not pending:
+                break
+            df, texts, jobs = pending.popleft()
+            tokens = {key: job.get() for key, job in jobs.items()}
+            outputs = {}
+            for future in [executor.submit(_predict_on_device, ms, tokens)
+                           for ms in by_device.values()]:
+                outputs.update(future.result())
+            prediction = np.zeros(len(df), dtype=np.float64)
+            for member in members:
+                y_pred = texts.scatter(outputs[id(member)])
+                prediction += member.weight * torch.sigmoid(
+                    torch.from_numpy(y_pred[:, 0])).numpy()
+            df['prediction'] = prediction / total_weight
+            writer.write(df[['id', 'prediction']])
+            n_texts += len(df)
+    for pool in pools.values():
+        pool.close()
+    elapsed = time.perf_counter() - start
+    for member in members:
+        print(f'{member.path} on {member.device}: {member.seconds:.1f} s')
+    print(f'{n_texts:,} texts in {elapsed:.1f} s with {len(members)} models '
+          f'and {len(groups)} vocabularies')
+    print(f'Saved blended predictions to {args.output}')
+
+
+def tokenizer_key(model_path: str) -> str:
+    """ Models with the same key get the same token ids for a text.
+    """
+    path = Path(model_path)
+    digest = hashlib.blake2b(digest_size=16)
+    # model kind and lower casing are defined by the name, see load_tokenizer
+    digest.update(f'{"bert" in model_path} {"uncased" in model_path}'
+                  .encode())
+    for name in TOKENIZER_FILES:
+        if (path / name).exists():
+            digest.update(name.encode())
+            digest.update((path / name).read_bytes())
+    return digest.hexdigest()
+
+
+if __name__ == '__main__':
+    main()
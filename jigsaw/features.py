@@ -0,0 +1,256 @@
+"""
+Features of a frozen BERT encoder (pooled output and [CLS] hidden states
+of selected layers) for experiments with classifier heads and losses
+which do not need encoder fine-tuning. Extract features of all training
+and test texts once, as float16 arrays in ``features_root``::
+
+    python -m jigsaw.features extract _runs/features --model bert-base-uncased
+
+and train heads on them on CPU, validating on the same fold as
+``jigsaw.bert``::
+
+    python -m jigsaw.features train _runs/features --head mlp --use pooled
+"""
+import argparse
+import copy
+from functools import partial
+import json
+import os
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+import tqdm
+
+from .bert import (
+    NUM_LABELS, TokenizerPool, device, get_loss, get_target, load_model,
+    load_tokenizer, preprocess_df, sorted_by_length, tokenize_lines,
+    trim_tensors)
+from .metrics import compute_bias_metrics_for_model
+from .precision import PRECISIONS, Precision, get_precision
+from .token_cache import cached_tokens
+from .utils import DATA_ROOT
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    arg = parser.add_argument
+    arg('action', choices=['extract', 'train'])
+    arg('features_root')
+    arg('--batch-size', type=int,
+        help='by default 64 for extract and 512 for train')
+    # extract
+    arg('--model', default='bert-base-uncased')
+    arg('--seq-length', type=int, default=296)
+    arg('--layers', type=int, nargs='+', default=[-1, -2, -3, -4],
+        help='encoder layers to save [CLS] hidden states of')
+    arg('--precision', choices=PRECISIONS)
+    arg('--tokenize-workers', type=int)
+    arg('--token-cache', help='token cache of jigsaw.bert to reuse')
+    # train
+    arg('--use', nargs='+',
+        help='features to train on, e.g. "pooled layer-1", by default all')
+    arg('--head', choices=['linear', 'mlp'], default='linear')
+    arg('--hidden-size', type=int, default=256)
+    arg('--dropout', type=float, default=0.1)
+    arg('--sample-weights', choices=['bias', 'none'], default='bias',
+        help='bias: weights of jigsaw.bert, none: equal weights')
+    arg('--aux-weight', type=float, default=1.,
+        help='weight of auxiliary targets in the loss')
+    arg('--epochs', type=int, default=5)
+    arg('--lr', type=float, default=1e-3)
+    arg('--seed', type=int, default=42)
+    arg('--fold', type=int, default=0)
+    arg('--folds', help='by default data/folds.json')
+    arg('--run-root',
+        help='save the best head, its validation predictions and submission')
+    args = parser.parse_args()
+
+    features_root = Path(args.features_root)
+    if args.action == 'extract':
+        if 'bert' not in args.model:
+            parser.error('features can be extracted only from BERT models')
+        extract(args, features_root)
+    else:
+        train_head(args, features_root)
+
+
+def load_df(split: str) -> pd.DataFrame:
+    if split == 'train':
+        train_pkl_path = DATA_ROOT / 'train.pkl'
+        if not train_pkl_path.exists():
+            pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
+        df = pd.read_pickle(train_pkl_path)
+    else:
+        df = pd.read_csv(DATA_ROOT / 'test.csv')
+    return preprocess_df(df).reset_index(drop=True)
+
+
+def extract(args, features_root: Path):
+    features_root.mkdir(exist_ok=True, parents=True)
+    names = ['pooled'] + [f'layer{layer}' for layer in args.layers]
+    tokenizer, pad_idx = load_tokenizer(args.model)
+    # start workers before the model is loaded and moved to the device
+    pool = TokenizerPool(tokenizer, use_bert=True, pad_idx=pad_idx,
+                         processes=args.tokenize_workers)
+    model = load_model(args.model).to(device)
+    precision = get_precision(args.precision, device)
+    model, _ = precision.prepare(model)
+    tokenize_texts = partial(
+        tokenize_lines, max_seq_length=args.seq_length, tokenizer=tokenizer,
+        use_bert=True, pad_idx=pad_idx, pool=pool)
+    for split in ['train', 'test']:
+        df = load_df(split)
+        texts = list(df['comment_text'])
+        if args.token_cache and split == 'train':
+            x = cached_tokens(Path(args.token_cache), texts, tokenize_texts,
+                              model=args.model, seq_length=args.seq_length)
+        else:
+            x = tokenize_texts(texts)
+        path = features_root / f'{split}.npy'
+        tmp_path = features_root / f'{split}.tmp.npy'
+        out = np.lib.format.open_memmap(
+            str(tmp_path), mode='w+', dtype=np.float16,
+            shape=(len(x), len(names), model.config.hidden_size))
+        encode(model, x, layers=args.layers, out=out, pad_idx=pad_idx,
+               batch_size=args.batch_size or 64, precision=precision)
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        np.save(features_root / f'{split}-ids.npy', df['id'].values)
+        print(f'Saved {split} features to {path}')
+    pool.close()
+    (features_root / 'features.json').write_text(json.dumps({
+        'model': args.model, 'seq_length': args.seq_length, 'names': names,
+    }, indent=4))
+
+
+def encode(model, x, *, layers: List[int], out: np.ndarray, pad_idx: int,
+           batch_size: int, precision: Precision):
+    """ Write pooled output and [CLS] hidden states of ``layers`` for
+    token ids ``x`` to ``out`` in the original order.
+    """
+    indices, x = sorted_by_length(np.asarray(x), pad_idx)
+    loader = DataLoader(
+        TensorDataset(torch.from_numpy(x), torch.from_numpy(indices)),
+        batch_size=batch_size, shuffle=False)
+    model.eval()
+    with torch.no_grad():
+        for x_batch, batch_indices in tqdm.tqdm(loader, desc='extract'):
+            x_batch, = trim_tensors([x_batch], pad_idx)
+            x_batch = x_batch.to(device).long()
+            with precision.autocast():
+                encoded_layers, pooled = model.bert(
+                    x_batch, attention_mask=x_batch != pad_idx,
+                    output_all_encoded_layers=True)
+            features = [pooled] + [encoded_layers[layer][:, 0]
+                                   for layer in layers]
+            out[batch_indices.numpy()] = (
+                torch.stack(features, 1).float().cpu().numpy())
+
+
+def train_head(args, features_root: Path):
+    info = json.loads((features_root / 'features.json').read_text())
+    use = [info['names'].index(name) for name in args.use or info['names']]
+    print(f'Training on {", ".join(info["names"][i] for i in use)} '
+          f'features of {info["model"]}')
+    batch_size = args.batch_size or 512
+    features = np.load(features_root / 'train.npy', mmap_mode='r')
+    df = load_df('train')
+    assert (np.load(features_root / 'train-ids.npy') == df['id'].values).all()
+    folds_path = Path(args.folds) if args.folds else DATA_ROOT / 'folds.json'
+    folds = json.loads(folds_path.read_text())
+    valid_index = df['id'].isin(folds[args.fold]).values
+    train_rows, valid_rows = [np.nonzero(mask)[0]
+                              for mask in [~valid_index, valid_index]]
+    df_valid = df.iloc[valid_rows].drop(columns=['comment_text'])
+    y_train, loss_weight = get_target(df.iloc[train_rows])
+    y_valid, _ = get_target(df_valid)
+    if args.sample_weights == 'none':
+        y_train[:, 1] = y_valid[:, 1] = loss_weight = 1
+    criterion = partial(get_loss, loss_weight=loss_weight,
+                        aux_weight=args.aux_weight)
+
+    torch.manual_seed(args.seed)
+    head = make_head(args.head, n_in=len(use) * features.shape[2],
+                     hidden_size=args.hidden_size, dropout=args.dropout)
+    optimizer = torch.optim.Adam(head.parameters(), lr=args.lr)
+    rng = np.random.RandomState(args.seed)
+    best_auc, best_state, best_predictions = 0, None, None
+    for epoch in range(args.epochs):
+        head.train()
+        order = rng.permutation(len(train_rows))
+        losses = []
+        for i in tqdm.trange(0, len(order), batch_size, leave=False,
+                             desc=f'epoch {epoch + 1}'):
+            # sorted rows are read from the memory mapped file faster
+            batch = np.sort(order[i: i + batch_size])
+            loss = criterion(
+                head(_features(features, train_rows[batch], use)),
+                torch.from_numpy(y_train[batch]).float())
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        y_pred = predict_head(head, features, valid_rows, use, batch_size)
+        valid_loss = criterion(y_pred, torch.from_numpy(y_valid).float())
+        df_valid['prediction'] = torch.sigmoid(y_pred[:, 0]).numpy()
+        metrics = compute_bias_metrics_for_model(df_valid, 'prediction')
+        print(f'epoch {epoch + 1}: loss {np.mean(losses):.4f} '
+              f'valid_loss {float(valid_loss):.4f} auc {metrics["auc"]:.4f}')
+        if metrics['auc'] > best_auc:
+            best_auc = metrics['auc']
+            best_state = copy.deepcopy(head.state_dict())
+            best_predictions = df_valid.copy()
+    print(f'best auc {best_auc:.4f}')
+
+    if args.run_root:
+        run_root = Path(args.run_root)
+        run_root.mkdir(exist_ok=True, parents=True)
+        (run_root / 'params.json').write_text(
+            json.dumps(vars(args), indent=4))
+        torch.save(best_state, run_root / 'head.pt')
+        best_predictions.to_csv(run_root / 'valid-predictions.csv', index=None)
+        head.load_state_dict(best_state)
+        test_features = np.load(features_root / 'test.npy', mmap_mode='r')
+        y_pred = predict_head(head, test_features,
+                              np.arange(len(test_features)), use, batch_size)
+        pd.DataFrame({
+            'id': np.load(features_root / 'test-ids.npy'),
+            'prediction': torch.sigmoid(y_pred[:, 0]).numpy(),
+        }).to_csv(run_root / 'submission.csv', index=None)
+        print(f'Saved head, validation predictions and submission '
+              f'to {run_root}')
+
+
+def make_head(kind: str, *, n_in: int, hidden_size: int, dropout: float):
+    if kind == 'linear':
+        return nn.Sequential(nn.Dropout(dropout), nn.Linear(n_in, NUM_LABELS))
+    return nn.Sequential(
+        nn.Dropout(dropout), nn.Linear(n_in, hidden_size), nn.ReLU(),
+        nn.Dropout(dropout), nn.Linear(hidden_size, NUM_LABELS))
+
+
+def predict_head(head: nn.Module, features: np.ndarray, rows: np.ndarray,
+                 use: List[int], batch_size: int) -> torch.Tensor:
+    head.eval()
+    with torch.no_grad():
+        return torch.cat([
+            head(_features(features, rows[i: i + batch_size], use))
+            for i in range(0, len(rows), batch_size)])
+
+
+def _features(features: np.ndarray, rows: np.ndarray,
+              use: List[int]) -> torch.Tensor:
+    x = features[rows][:, use]
+    return torch.from_numpy(x.reshape(len(rows), -1).astype(np.float32))
+
+
+if __name__ == '__main__':
+    main()
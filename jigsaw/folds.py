@@ -1,6 +1,8 @@
+import argparse
 import json
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 from .utils import DATA_ROOT
@@ -8,10 +10,22 @@ from .metrics import IDENTITY_COLUMNS
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--n-folds', type=int, default=1,
+        help='split all data into this many folds, by default one '
+             'validation fold of annotated and not annotated samples')
+    args = parser.parse_args()
+
     train_pkl_path = DATA_ROOT / 'train.pkl'
     if not train_pkl_path.exists():
         pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
     df = pd.read_pickle(train_pkl_path)
+    if args.n_folds > 1:
+        folds = kfold_ids(df, args.n_folds)
+        print('fold sizes', list(map(len, folds)))
+        Path('data/folds.json').write_text(json.dumps(folds, indent=4))
+        return
     annot_df = (df[df['identity_annotator_count'] > 0]
                 .sample(n=48660, random_state=13))
     not_annot_df = (df[df['identity_annotator_count'] == 0]
@@ -33,5 +47,18 @@ def main():
     Path('data/folds.json').write_text(json.dumps(folds, indent=4))
 
 
+def kfold_ids(df: pd.DataFrame, n_folds: int):
+    """ Split ids into folds, with annotated and not annotated
+    samples spread evenly between them.
+    """
+    folds = [[] for _ in range(n_folds)]
+    annotated = df['identity_annotator_count'].fillna(0) > 0
+    for part in [df[annotated], df[~annotated]]:
+        ids = part['id'].sample(frac=1, random_state=13).values
+        for fold, fold_ids in zip(folds, np.array_split(ids, n_folds)):
+            fold.extend(map(int, fold_ids))
+    return folds
+
+
 if __name__ == '__main__':
     main()
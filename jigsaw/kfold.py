@@ -0,0 +1,175 @@
+"""
+Train all folds as parallel jobs and assemble out-of-fold validation
+predictions and fold-averaged test predictions::
+
+    python -m jigsaw.kfold _runs/kfold --gpus 0 1 -- --epochs 2
+
+Options after ``--`` are passed to ``jigsaw.bert``. Each fold is trained
+and predicts test.csv in ``run_root/foldN``, job logs are in
+``run_root/logs``. Token ids are computed once and shared between folds.
+Failed jobs are retried, resuming from the last checkpoint. Running the
+same command again skips completed folds.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from pathlib import Path
+from queue import Queue
+import shutil
+import subprocess
+import sys
+from typing import Dict, List
+
+import pandas as pd
+
+from .metrics import compute_bias_metrics_for_model
+from .utils import DATA_ROOT
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=__doc__)
+    arg = parser.add_argument
+    arg('run_root')
+    arg('--folds', default=str(DATA_ROOT / 'folds.json'),
+        help='json file with validation ids of each fold')
+    arg('--only-folds', type=int, nargs='+', help='run only these folds')
+    arg('--gpus', nargs='+', default=[],
+        help='GPU ids, each fold job gets one of them')
+    arg('--slots', type=int,
+        help='number of concurrent fold jobs, by default one per GPU, '
+             'or one on CPU')
+    arg('--retries', type=int, default=1)
+    arg('--token-cache', help='by default run_root/token-cache')
+    argv = sys.argv[1:]
+    bert_args = []
+    if '--' in argv:
+        argv, bert_args = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    run_root = Path(args.run_root)
+    (run_root / 'logs').mkdir(exist_ok=True, parents=True)
+    n_folds = len(json.loads(Path(args.folds).read_text()))
+    folds = args.only_folds or list(range(n_folds))
+    n_slots = args.slots or max(1, len(args.gpus))
+
+    # all folds would create it at the same time otherwise
+    train_pkl_path = DATA_ROOT / 'train.pkl'
+    if not train_pkl_path.exists():
+        pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
+
+    slots = Queue()
+    for slot in range(n_slots):
+        slots.put(slot_env(slot, n_slots, args.gpus))
+    job = FoldJob(
+        run_root, folds_path=args.folds, retries=args.retries,
+        token_cache=args.token_cache or str(run_root / 'token-cache'),
+        bert_args=bert_args, slots=slots)
+    with ThreadPoolExecutor(n_slots) as executor:
+        succeeded = dict(zip(folds, executor.map(job.run, folds)))
+    failed = [fold for fold, ok in succeeded.items() if not ok]
+    if failed:
+        print(f'Folds {failed} failed, see logs in {run_root / "logs"}')
+        sys.exit(1)
+    assemble_predictions(run_root, folds)
+
+
+def slot_env(slot: int, n_slots: int, gpus: List[str]) -> Dict[str, str]:
+    """ Environment of jobs running in ``slot``: a GPU of its own,
+    or an equal share of CPU cores.
+    """
+    env = dict(os.environ)
+    if gpus:
+        env['CUDA_VISIBLE_DEVICES'] = gpus[slot % len(gpus)]
+    else:
+        env['CUDA_VISIBLE_DEVICES'] = ''
+        threads = str(max(1, len(os.sched_getaffinity(0)) // n_slots))
+        env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = threads
+    return env
+
+
+class FoldJob:
+    """ Trains one fold and predicts test.csv with it,
+    in ``jigsaw.bert`` subprocesses which run in a free slot.
+    """
+    def __init__(self, run_root: Path, *, folds_path: str, token_cache: str,
+                 retries: int, bert_args: List[str], slots: Queue):
+        self.run_root = run_root
+        self.folds_path = folds_path
+        self.token_cache = token_cache
+        self.retries = retries
+        self.bert_args = bert_args
+        self.slots = slots
+
+    def run(self, fold: int) -> bool:
+        fold_root = self.run_root / f'fold{fold}'
+        if (fold_root / 'submission.csv').exists():
+            print(f'fold {fold}: done')
+            return True
+        env = self.slots.get()
+        try:
+            return (self._run_stage(fold, 'train', env) and
+                    self._run_stage(fold, 'submission', env))
+        finally:
+            self.slots.put(env)
+
+    def _run_stage(self, fold: int, stage: str, env) -> bool:
+        fold_root = self.run_root / f'fold{fold}'
+        for attempt in range(self.retries + 1):
+            command = [
+                sys.executable, '-m', 'jigsaw.bert', str(fold_root),
+                '--fold', str(fold), '--folds', self.folds_path,
+                '--token-cache', self.token_cache] + self.bert_args
+            if stage == 'submission':
+                command.append('--submission')
+            elif (fold_root / 'optimizer.pt').exists():
+                command.append('--resume')
+            elif fold_root.exists():
+                shutil.rmtree(fold_root)  # failed before the first checkpoint
+            log_path = (self.run_root / 'logs' /
+                        f'fold{fold}-{stage}-{attempt}.log')
+            print(f'fold {fold}: {stage}, attempt {attempt + 1}, '
+                  f'log {log_path}')
+            with log_path.open('w') as log:
+                returncode = subprocess.call(
+                    command, env=env, stdin=subprocess.DEVNULL,
+                    stdout=log, stderr=subprocess.STDOUT)
+            if returncode == 0:
+                return True
+            print(f'fold {fold}: {stage} failed with code {returncode}')
+        return False
+
+
+def assemble_predictions(run_root: Path, folds: List[int]):
+    """ Save out-of-fold validation predictions (``fold`` is the fold
+    which predicted them) and test predictions averaged over folds
+    (``fold`` is -1) to ``run_root/predictions.csv``.
+    """
+    oof = []
+    test = []
+    for fold in folds:
+        fold_root = run_root / f'fold{fold}'
+        df = pd.read_csv(fold_root / 'valid-predictions.csv')
+        metrics = compute_bias_metrics_for_model(df, 'prediction')
+        print(f'fold {fold}: auc {metrics["auc"]:.4f}')
+        df['fold'] = fold
+        oof.append(df)
+        test.append(pd.read_csv(fold_root / 'submission.csv'))
+    df_oof = pd.concat(oof, ignore_index=True)
+    metrics = compute_bias_metrics_for_model(df_oof, 'prediction')
+    print(f'out-of-fold auc {metrics["auc"]:.4f}')
+    df_test = (pd.concat(test).groupby('id', as_index=False)['prediction']
+               .mean())
+    df_test['fold'] = -1
+    df_oof['split'] = 'valid'
+    df_test['split'] = 'test'
+    columns = ['id', 'split', 'fold', 'prediction']
+    path = run_root / 'predictions.csv'
+    pd.concat([df_oof[columns], df_test[columns]]).to_csv(path, index=None)
+    print(f'Saved predictions to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
 import csv
+import fcntl
+import hashlib
+from itertools import chain
+import multiprocessing
+import os
 from pathlib import Path
-from typing import List
+import shutil
+from typing import List, Tuple
 
+import numpy as np
 import sentencepiece
 
 
@@ -55,15 +62,157 @@ def encode_comment(sp_model: sentencepiece.SentencePieceProcessor,
     """ Encode one comment with sentencepiece model.
     """
     # TODO we can do sub-word augmentation here
-    start = sp_model.PieceToId('<s>')
-    end = sp_model.PieceToId('</s>')
-    eol = sp_model.PieceToId(EOL)
+    encoded = _encode(sp_model, _special_ids(sp_model), comment)
+    if max_len is not None:
+        encoded = encoded[:max_len]
+    return encoded
+
+
+def _special_ids(sp_model) -> Tuple[int, int, int]:
+    return (sp_model.PieceToId('<s>'), sp_model.PieceToId('</s>'),
+            sp_model.PieceToId(EOL))
+
+
+def _encode(sp_model, special_ids: Tuple[int, int, int],
+            comment: str) -> List[int]:
+    start, end, eol = special_ids
     encoded = [start]
     for i, line in enumerate(comment.split('\n')):
         if i:
             encoded.append(eol)
         encoded.extend(sp_model.EncodeAsIds(line))
     encoded.append(end)
-    if max_len is not None:
-        encoded = encoded[:max_len]
     return encoded
+
+
+def encode_comments(sp_model: sentencepiece.SentencePieceProcessor,
+                    comments: List[str], *, workers: int = None,
+                    chunk_size: int = 10000,
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+    """ Encode comments as ``encode_comment`` does (without truncation)
+    in ``workers`` processes (by default one per core, 0 to encode
+    in this process). Return a flat uint16 array of token ids of all
+    comments and int64 lengths of each comment.
+    """
+    assert len(sp_model) <= 2 ** 16
+    chunks = [comments[i: i + chunk_size]
+              for i in range(0, len(comments), chunk_size)]
+    if workers is None:
+        workers = os.cpu_count()
+    workers = min(workers, len(chunks))
+    if workers <= 1:
+        _init_encoder_worker(sp_model)
+        results = list(map(_encode_chunk, chunks))
+    else:
+        with multiprocessing.Pool(
+                workers, initializer=_init_encoder_worker,
+                initargs=(sp_model.serialized_model_proto(),)) as pool:
+            results = pool.map(_encode_chunk, chunks)
+    if not results:
+        return np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.int64)
+    ids, lengths = zip(*results)
+    return np.concatenate(ids), np.concatenate(lengths)
+
+
+_worker_sp_model = _worker_special_ids = None
+
+
+def _init_encoder_worker(sp_model):
+    """ ``sp_model`` is a serialized model proto in worker processes.
+    """
+    global _worker_sp_model, _worker_special_ids
+    if isinstance(sp_model, bytes):
+        proto = sp_model
+        sp_model = sentencepiece.SentencePieceProcessor()
+        sp_model.LoadFromSerializedProto(proto)
+    _worker_sp_model = sp_model
+    _worker_special_ids = _special_ids(sp_model)
+
+
+def _encode_chunk(comments: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [_encode(_worker_sp_model, _worker_special_ids, comment)
+               for comment in comments]
+    lengths = np.array([len(x) for x in encoded], dtype=np.int64)
+    ids = np.fromiter(chain.from_iterable(encoded), dtype=np.uint16,
+                      count=int(lengths.sum()))
+    return ids, lengths
+
+
+class EncodedComments:
+    """ Comments encoded with ``encode_comment`` (not truncated) as a flat
+    uint16 array of token ids with offsets and lengths of each comment,
+    and optionally a float32 matrix of targets. Loaded arrays are memory
+    mapped, so workers share them and a comment is a slice of ``ids``.
+    """
+    ARRAYS = ['ids', 'offsets', 'lengths', 'targets']
+
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray,
+                 lengths: np.ndarray, targets: np.ndarray = None):
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = lengths
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        start = self.offsets[idx]
+        return self.ids[start: start + self.lengths[idx]]
+
+    @classmethod
+    def encode(cls, sp_model: sentencepiece.SentencePieceProcessor,
+               comments: List[str], targets: np.ndarray = None,
+               workers: int = None) -> 'EncodedComments':
+        ids, lengths = encode_comments(sp_model, comments, workers=workers)
+        offsets = np.zeros_like(lengths)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        if targets is not None:
+            targets = np.asarray(targets, dtype=np.float32)
+            assert not np.isnan(targets).any()
+        return cls(ids, offsets, lengths, targets)
+
+    def save(self, root: Path):
+        """ Save to a new ``root`` directory, which appears only
+        when all arrays are written.
+        """
+        tmp_root = root.with_name(f'{root.name}.tmp')
+        if tmp_root.exists():
+            shutil.rmtree(tmp_root)
+        tmp_root.mkdir(parents=True)
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(tmp_root / f'{name}.npy', array)
+        os.replace(tmp_root, root)
+
+    @classmethod
+    def load(cls, root: Path) -> 'EncodedComments':
+        arrays = {name: np.load(root / f'{name}.npy', mmap_mode='r')
+                  for name in cls.ARRAYS if (root / f'{name}.npy').exists()}
+        return cls(**arrays)
+
+
+def cached_encoding(cache_root: Path, sp_model_path: str,
+                    comments: List[str], targets: np.ndarray = None,
+                    workers: int = None) -> EncodedComments:
+    """ Return ``EncodedComments`` for ``comments`` and ``targets``,
+    encoded once for the same sentencepiece model and data and stored
+    in ``cache_root``.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(Path(sp_model_path).read_bytes())
+    for comment in comments:
+        h.update(comment.encode('utf8'))
+        h.update(b'\0')
+    if targets is not None:
+        h.update(np.ascontiguousarray(targets, dtype=np.float32).tobytes())
+    cache_root.mkdir(exist_ok=True, parents=True)
+    root = cache_root / f'encoded-{h.hexdigest()}'
+    with open(cache_root / f'{root.name}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not root.exists():
+            EncodedComments.encode(
+                load_sp_model(sp_model_path), comments, targets,
+                workers=workers).save(root)
+    return EncodedComments.load(root)
@@ -0,0 +1,63 @@
+"""
+Embeddings of sentencepiece pieces from a fastText model, for
+``jigsaw.lstm.main --embed-init``. The matrix is cached as .npy, so that
+the fastText model is loaded only once for a pair of models.
+"""
+import fcntl
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .dataset import load_sp_model
+
+
+def cached_fasttext_matrix(cache_root: Path, sp_model_path: str,
+                           fasttext_path: str) -> np.ndarray:
+    """ Return a float32 matrix with fastText vectors of all pieces
+    of the sentencepiece model, built once for the same files.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(Path(sp_model_path).read_bytes())
+    h.update(_large_file_digest(Path(fasttext_path)))
+    cache_root.mkdir(exist_ok=True, parents=True)
+    path = cache_root / f'embeddings-{h.hexdigest()}.npy'
+    with open(cache_root / f'{path.name}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not path.exists():
+            import fastText
+            ft_model = fastText.load_model(fasttext_path)
+            matrix = fasttext_matrix(load_sp_model(sp_model_path), ft_model)
+            del ft_model
+            tmp_path = path.with_name(f'{path.stem}.tmp.npy')
+            np.save(tmp_path, matrix)
+            os.replace(tmp_path, path)
+    return np.load(path)
+
+
+def fasttext_matrix(sp_model, ft_model) -> np.ndarray:
+    """ Vectors of pieces without the word boundary mark, written
+    to one preallocated matrix.
+    """
+    matrix = np.empty((len(sp_model), ft_model.get_dimension()),
+                      dtype=np.float32)
+    for i in range(len(sp_model)):
+        matrix[i] = ft_model.get_word_vector(
+            sp_model.IdToPiece(i).strip('▁'))
+    return matrix
+
+
+def _large_file_digest(path: Path, block_size: int = 2 ** 20) -> bytes:
+    """ Digest of the size and of the first and last blocks of a file,
+    as hashing all of a multi-gigabyte model would take longer
+    than using the cache saves.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    size = path.stat().st_size
+    h.update(str(size).encode())
+    with path.open('rb') as f:
+        h.update(f.read(block_size))
+        f.seek(max(0, size - block_size))
+        h.update(f.read(block_size))
+    return h.digest()
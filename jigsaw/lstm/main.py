@@ -1,76 +1,236 @@
 import argparse
+import contextlib
 import json
 from pathlib import Path
 import statistics
 import shutil
+import time
+from typing import Tuple
 
-import fastText
 import json_log_plots
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import KFold
 import torch
 import torch.cuda
 from torch import nn, optim
 from torch.utils.data import DataLoader, Dataset
-from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data.sampler import Sampler
 import tqdm
 
+from ..averaging import AVERAGE_KINDS, WeightAverage
+from ..prediction_cache import (
+    DedupedTexts, PredictionCache, model_fingerprint)
+from ..streaming import IdOrderedCsvWriter, read_chunks
 from ..utils import DATA_ROOT
-from .dataset import encode_comment, load_sp_model, SP_MODEL
+from .dataset import (
+    EncodedComments, cached_encoding, load_sp_model, SP_MODEL)
+from .embeddings import cached_fasttext_matrix
 from ..metrics import compute_bias_metrics_for_model, MAIN_METRICS
 from . import models
 
 
 class JigsawDataset(Dataset):
+    """ Items are whole batches: ``dataset[idx]`` for an array of indices
+    ``idx`` (from ``BucketBatchSampler``) is a collated batch, see
+    ``batch_loader``.
+    """
     AUX_TARGETS = [
         'target',
         'severe_toxicity', 'obscene', 'identity_attack', 'insult', 'threat']
 
-    def __init__(self, df, sp_model, max_len: int):
+    def __init__(self, encoded: EncodedComments, max_len: int,
+                 rows: np.ndarray = None, soft_targets: np.ndarray = None):
+        """ Indices are of ``rows`` of ``encoded`` (all by default),
+        ``soft_targets`` are aligned with ``rows``.
+        """
         super().__init__()
-        self.df = df
-        self.sp_model = sp_model
-        self.max_len = max_len
-        self.has_target = 'target' in df.columns
+        self.encoded = encoded
+        self.rows = np.arange(len(encoded)) if rows is None else rows
+        self.lengths = np.minimum(encoded.lengths[self.rows], max_len)
+        self.has_target = encoded.targets is not None
+        self.soft_targets = soft_targets
 
     def __len__(self):
-        return len(self.df)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        item = self.df.iloc[idx]
-        comment = encode_comment(self.sp_model, item.comment_text,
-                                 max_len=self.max_len)
-        comment = torch.tensor(comment, dtype=torch.int64)
+        """ Return comments sorted by length (descending) and padded
+        with zeros, their lengths, ``indices`` which restore the order
+        of ``idx``, and targets if they are known.
+        """
+        idx = np.asarray(idx)
+        order = np.argsort(-self.lengths[idx], kind='stable')
+        idx = idx[order]
+        lengths = self.lengths[idx]
+        rows = self.rows[idx]
+        positions = np.arange(lengths[0])
+        mask = positions < lengths[:, None]
+        comments = np.zeros(mask.shape, dtype=np.int64)
+        comments[mask] = self.encoded.ids[
+            (self.encoded.offsets[rows][:, None] + positions)[mask]]
+        indices = np.empty_like(order)
+        indices[order] = np.arange(len(order))
+        collated = (torch.from_numpy(comments), torch.from_numpy(lengths),
+                    torch.from_numpy(indices))
         if self.has_target:
-            target = torch.tensor(
-                [float(item.target >= 0.5)] +
-                [getattr(item, col) for col in self.AUX_TARGETS])
-            assert not torch.isnan(target).any()
-            return comment, target
+            targets = np.asarray(self.encoded.targets[rows])
+            if self.soft_targets is not None:
+                # appended to hard targets, so that batches are collated
+                # in the same way
+                targets = np.concatenate(
+                    [targets, self.soft_targets[idx]], axis=1)
+            collated += (torch.from_numpy(targets.astype(np.float32)),)
+        return collated
+
+
+class BucketBatchSampler(Sampler):
+    """ Batches of dataset indices. With ``shuffle``, indices are shuffled
+    each epoch, split into pools of ``pool_batches`` batches and sorted by
+    length in each pool, and batches cut from pools are shuffled, so that
+    each batch has comments of similar length and little padding
+    (``pool_batches=0`` gives uniformly random batches). Without
+    ``shuffle``, batches go in order of descending length.
+    """
+    def __init__(self, lengths: np.ndarray, batch_size: int, *,
+                 shuffle: bool, pool_batches: int = 50, seed: int = 42):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        n = len(self.lengths)
+        if self.shuffle:
+            rng = np.random.RandomState([self.seed, self.epoch])
+            self.epoch += 1
+            order = rng.permutation(n)
+            if self.pool_batches:
+                pool = self.pool_batches * self.batch_size
+                order = np.concatenate([
+                    chunk[np.argsort(-self.lengths[chunk], kind='stable')]
+                    for chunk in np.split(order, range(pool, n, pool))])
         else:
-            return comment
+            order = np.argsort(-self.lengths, kind='stable')
+        batches = [order[i: i + self.batch_size]
+                   for i in range(0, n, self.batch_size)]
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return -(-len(self.lengths) // self.batch_size)
 
 
-def collate_fn(inputs):
-    has_target = not isinstance(inputs[0], torch.Tensor)
-    if has_target:
-        inputs = [(i, x, y) for i, (x, y) in enumerate(inputs)]
-    else:
-        inputs = list(enumerate(inputs))
-    inputs = sorted(inputs, key=lambda x: len(x[1]), reverse=True)
-    inverse = {x[0]: i for i, x in enumerate(inputs)}
-    indices = [inverse[i] for i in range(len(inverse))]
-    comments = [x[1] for x in inputs]
-    if has_target:
-        targets = torch.stack([x[2] for x in inputs])
-    else:
-        targets = None
-    lengths = torch.tensor(list(map(len, comments)))
-    comments = pad_sequence(comments, batch_first=True)
-    collated = (comments, lengths, indices)
-    if has_target:
-        collated += (targets,)
-    return collated
+def batch_loader(dataset: JigsawDataset, sampler: BucketBatchSampler,
+                 workers: int) -> DataLoader:
+    return DataLoader(
+        dataset,
+        sampler=sampler,
+        batch_size=1,  # each dataset item is a batch
+        num_workers=workers,
+        collate_fn=_single_item,
+    )
+
+
+def _single_item(items):
+    item, = items
+    return item
+
+
+def get_targets(df: pd.DataFrame) -> np.ndarray:
+    """ Binary toxicity and auxiliary targets, in model output order.
+    """
+    return np.concatenate([
+        (df['target'].values >= 0.5)[:, None],
+        df[JigsawDataset.AUX_TARGETS].values,
+    ], axis=1).astype(np.float32)
+
+
+def predict_texts(model: nn.Module, texts, *, sp_model, max_len: int,
+                  batch_size: int, workers: int, device) -> np.ndarray:
+    """ Return model outputs for ``texts`` in the original order.
+    """
+    dataset = JigsawDataset(
+        EncodedComments.encode(sp_model, list(texts), workers=workers),
+        max_len)
+    sampler = BucketBatchSampler(dataset.lengths, batch_size, shuffle=False)
+    n_out = 1 + len(JigsawDataset.AUX_TARGETS)
+    predictions = np.zeros((len(dataset), n_out), dtype=np.float32)
+    model.eval()
+    with torch.no_grad():
+        for idx, (xs, lengths, indices) in zip(sampler, tqdm.tqdm(
+                batch_loader(dataset, sampler, workers),
+                dynamic_ncols=True, leave=False)):
+            xs = xs.to(device)
+            predictions[idx] = model(xs, lengths)[indices].cpu().numpy()
+    return predictions
+
+
+def load_run(run_path: Path, device):
+    """ Return the model saved by train in ``run_path``,
+    its sentencepiece model and params.
+    """
+    state = torch.load(Path(run_path) / 'net.pt', map_location=device)
+    params = state['params']
+    sp_model = load_sp_model(params['sp_model'])
+    model: nn.Module = getattr(models, params['model'])(
+        n_vocab=len(sp_model),
+        n_embed=params['n_embed'],
+        n_out=1 + len(JigsawDataset.AUX_TARGETS),
+    )
+    model.load_state_dict(state['state_dict'])
+    return model.to(device).eval(), sp_model, params
+
+
+def split_rows(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """ Positions of training and validation rows of train.pkl,
+    the same for all runs.
+    """
+    kfold = KFold(n_splits=10, shuffle=True, random_state=42)
+    return next(kfold.split(df))
+
+
+def teacher_logits(teacher, df: pd.DataFrame) -> np.ndarray:
+    """ Logits of the teacher model saved by ``jigsaw.bert --teacher-logits``
+    for rows of ``df``.
+    """
+    return teacher['logits'][_teacher_rows(teacher, df)].astype(np.float32)
+
+
+def teacher_out_of_fold(teacher, df: pd.DataFrame) -> np.ndarray:
+    """ Mask of rows of ``df`` which the teacher was not trained on.
+    """
+    return teacher['out_of_fold'][_teacher_rows(teacher, df)]
+
+
+def _teacher_rows(teacher, df: pd.DataFrame) -> np.ndarray:
+    positions = pd.Series(np.arange(len(teacher['ids'])), index=teacher['ids'])
+    return positions[df['id']].values
+
+
+def compare_teacher(teacher, pred_df: pd.DataFrame):
+    """ Print auc of the student (``pred`` column) and of the teacher
+    on validation rows which the teacher was not trained on either.
+    """
+    if 'out_of_fold' not in teacher:
+        print('teacher logits do not mark out-of-fold rows, '
+              'save them again with jigsaw.bert --teacher-logits')
+        return
+    pred_df = pred_df[teacher_out_of_fold(teacher, pred_df)].copy()
+    if not len(pred_df):
+        print('no validation rows are out-of-fold for the teacher')
+        return
+    pred_df['teacher'] = torch.sigmoid(torch.from_numpy(
+        teacher_logits(teacher, pred_df)[:, 0])).numpy()
+    student_metrics = compute_bias_metrics_for_model(pred_df, 'pred')
+    teacher_metrics = compute_bias_metrics_for_model(pred_df, 'teacher')
+    print(f'on {len(pred_df):,} rows out-of-fold for the teacher: '
+          f'student auc {student_metrics["auc"]:.4f}, '
+          f'teacher auc {teacher_metrics["auc"]:.4f} '
+          f'{float(teacher["texts_per_s"]):,.0f} texts/s')
 
 
 def main():
@@ -87,10 +247,31 @@ def main():
     arg('--epochs', type=int, default=10)
     arg('--workers', type=int, default=4)
     arg('--validate-every', type=int, default=1000)
+    arg('--bucket-pool', type=int, default=50,
+        help='batches in a pool sorted by length, 0 for random batches')
     arg('--clean', action='store_true')
     arg('--n-embed', type=int, default=128)
     arg('--embed-init')
     arg('--embed-freeze', type=int, default=0)
+    arg('--average', choices=AVERAGE_KINDS,
+        help='validate and save averaged weights: exponential (ema) '
+             'or equal (swa) average over steps')
+    arg('--average-decay', type=float, default=0.999)
+    arg('--average-start', type=int, default=0,
+        help='steps before averaging starts')
+    arg('--average-every', type=int, default=1,
+        help='average weights every this many optimizer steps')
+    arg('--encoded-cache',
+        help='directory for encoded training comments and embedding '
+             'matrices, by default data/encoded')
+    arg('--teacher', help='teacher-logits.npz from jigsaw.bert to distill')
+    arg('--distill-alpha', type=float, default=0.5,
+        help='weight of the loss on teacher predictions')
+    arg('--distill-temperature', type=float, default=1.)
+    arg('--chunk-size', type=int, default=20000,
+        help='rows of test.csv predicted at once by submit')
+    arg('--prediction-cache', help='sqlite file to cache predictions in')
+    arg('--prediction-cache-size', type=int, default=10 ** 7)
     args = parser.parse_args()
 
     run_path = Path(args.run_path)
@@ -108,8 +289,10 @@ def main():
         for p in Path('jigsaw').glob('*.py'):
             shutil.copy(p, run_path)
     else:
-        # args are ignored
+        # args are ignored, except for inference options
         params = json.loads(params_path.read_text())
+        params.update({k: getattr(args, k) for k in [
+            'chunk_size', 'prediction_cache', 'prediction_cache_size']})
     del args
 
     sp_model = load_sp_model(params['sp_model'])
@@ -118,26 +301,35 @@ def main():
         if not train_pkl_path.exists():
             pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
         df = pd.read_pickle(train_pkl_path)
-        kfold = KFold(n_splits=10, shuffle=True, random_state=42)
-        train_ids, valid_ids = next(kfold.split(df))
+        train_ids, valid_ids = split_rows(df)
         train_df, valid_df = df.iloc[train_ids], df.iloc[valid_ids]
+        encoded = cached_encoding(
+            Path(params.get('encoded_cache') or DATA_ROOT / 'encoded'),
+            params['sp_model'], list(df['comment_text']), get_targets(df))
 
-        train_dataset = JigsawDataset(train_df, sp_model, params['max_len'])
-        train_loader = DataLoader(
+        teacher = soft_targets = None
+        if params.get('teacher'):
+            teacher = np.load(params['teacher'])
+            if action == 'train':
+                soft_targets = torch.sigmoid(torch.from_numpy(
+                    teacher_logits(teacher, train_df) /
+                    params['distill_temperature'])).numpy()
+        train_dataset = JigsawDataset(encoded, params['max_len'],
+                                      rows=train_ids,
+                                      soft_targets=soft_targets)
+        train_loader = batch_loader(
             train_dataset,
-            batch_size=params['batch_size'],
-            shuffle=True,
-            num_workers=params['workers'],
-            collate_fn=collate_fn,
-        )
-        valid_dataset = JigsawDataset(valid_df, sp_model, params['max_len'])
-        valid_loader = DataLoader(
+            BucketBatchSampler(
+                train_dataset.lengths, params['batch_size'], shuffle=True,
+                pool_batches=params.get('bucket_pool', 0)),
+            params['workers'])
+        valid_dataset = JigsawDataset(encoded, params['max_len'],
+                                      rows=valid_ids)
+        valid_loader = batch_loader(
             valid_dataset,
-            batch_size=params['batch_size'],
-            shuffle=False,
-            num_workers=params['workers'],
-            collate_fn=collate_fn,
-        )
+            BucketBatchSampler(valid_dataset.lengths, params['batch_size'],
+                               shuffle=False),
+            params['workers'])
         print(f'train size: {len(train_dataset):,} '
               f'valid size: {len(valid_dataset):,}')
 
@@ -154,12 +346,11 @@ def main():
             model.embedding.weight.requires_grad = False
         if params['embed_init']:
             print('loading embeddings')
-            ft_model = fastText.load_model(params['embed_init'])
-            for i in range(len(sp_model)):
-                model.embedding.weight[i] = torch.tensor(
-                    ft_model.get_word_vector(
-                        sp_model.IdToPiece(i).strip('▁')))
-            del ft_model
+            matrix = cached_fasttext_matrix(
+                Path(params['encoded_cache'] or DATA_ROOT / 'encoded'),
+                params['sp_model'], params['embed_init'])
+            with torch.no_grad():
+                model.embedding.weight.copy_(torch.from_numpy(matrix))
         print(model)
 
     model.to(device)
@@ -168,11 +359,18 @@ def main():
     criterion = nn.BCEWithLogitsLoss(pos_weight=pos_weight).to(device)
     lr_scheduler = torch.optim.lr_scheduler.LambdaLR(
         optimizer, lambda epoch: params['lr_power_base'] ** epoch)
+    weight_average = None
+    if action == 'train' and params.get('average'):
+        weight_average = WeightAverage(
+            model, kind=params['average'], decay=params['average_decay'],
+            start=params['average_start'],
+            every=params['average_every'])
     step = 0
 
     def save():
         torch.save({
-            'state_dict': model.state_dict(),
+            'state_dict': (weight_average.averaged_state_dict(model)
+                           if weight_average else model.state_dict()),
             'params': params,
         }, save_path)
 
@@ -180,58 +378,74 @@ def main():
         optimizer.zero_grad()
         xs, ys = xs.to(device), ys.to(device)
         ys_pred = model(xs, lengths)
-        loss = criterion(ys_pred, ys)
+        if ys.shape[1] > ys_pred.shape[1]:
+            ys, ys_soft = ys[:, :ys_pred.shape[1]], ys[:, ys_pred.shape[1]:]
+            alpha = params['distill_alpha']
+            t = params['distill_temperature']
+            loss = ((1 - alpha) * criterion(ys_pred, ys) +
+                    alpha * t ** 2 * criterion(ys_pred / t, ys_soft))
+        else:
+            loss = criterion(ys_pred, ys)
         loss.backward()
         optimizer.step()
+        if weight_average is not None:
+            weight_average.update(model)
         return loss.item()
 
     def get_validation_metrics():
         losses = []
-        predictions = []
+        predictions = np.zeros(len(valid_dataset), dtype=np.float32)
         model.eval()
+        start = time.perf_counter()
         with torch.no_grad():
-            for xs, lengths, indices, ys in tqdm.tqdm(
-                    valid_loader,
-                    desc='validate', dynamic_ncols=True, leave=False):
+            for idx, (xs, lengths, indices, ys) in zip(
+                    valid_loader.sampler, tqdm.tqdm(
+                        valid_loader,
+                        desc='validate', dynamic_ncols=True, leave=False)):
                 xs, ys = xs.to(device), ys.to(device)
                 ys_pred = model(xs, lengths)
                 loss = criterion(ys_pred, ys)
                 losses.append(loss.item())
-                predictions.extend(
-                    map(float, torch.sigmoid(ys_pred[indices, 0]).data.cpu()))
+                predictions[idx] = torch.sigmoid(
+                    ys_pred[indices, 0]).cpu().numpy()
         model.train()
+        texts_per_s = len(predictions) / (time.perf_counter() - start)
         valid_loss_value = statistics.mean(losses)
-        pred_df = valid_loader.dataset.df.copy()
+        pred_df = valid_df.drop(columns=['comment_text'])
         pred_df['pred'] = predictions
         metrics = compute_bias_metrics_for_model(pred_df, 'pred')
         metrics['valid_loss'] = valid_loss_value
-        return metrics
+        metrics['texts_per_s'] = texts_per_s
+        return metrics, pred_df
 
     def validate():
+        with (weight_average.swapped(model) if weight_average
+              else contextlib.suppress()):
+            metrics, _ = get_validation_metrics()
         json_log_plots.write_event(
-            run_path, step * params['batch_size'], **get_validation_metrics())
+            run_path, step * params['batch_size'], **metrics)
 
     def submit():
-        test_df = pd.read_csv(DATA_ROOT / 'test.csv')
         model.eval()
-        test_dataset = JigsawDataset(test_df, sp_model, params['max_len'])
-        test_loader = DataLoader(
-            test_dataset,
-            batch_size=params['batch_size'],
-            shuffle=False,
-            num_workers=params['workers'],
-            collate_fn=collate_fn,
-        )
-        predictions = []
-        with torch.no_grad():
-            for xs, lengths, indices in tqdm.tqdm(
-                    test_loader, dynamic_ncols=True, leave=False):
-                xs = xs.to(device)
-                ys = torch.sigmoid(model(xs, lengths)[indices, 0])
-                predictions.extend(map(float, ys.data.cpu()))
-        test_df.pop('comment_text')
-        test_df['prediction'] = predictions
-        test_df.to_csv('submission.csv', index=None)
+        cache = None
+        if params['prediction_cache']:
+            fingerprint = model_fingerprint(
+                model, sp_model=params['sp_model'], max_len=params['max_len'])
+            cache = PredictionCache(params['prediction_cache'], fingerprint,
+                                    max_size=params['prediction_cache_size'])
+        with IdOrderedCsvWriter('submission.csv') as writer:
+            for test_df in read_chunks(DATA_ROOT / 'test.csv',
+                                       chunk_size=params['chunk_size']):
+                texts = DedupedTexts(test_df.pop('comment_text'), cache=cache,
+                                     normalize=True)
+                ys = texts.scatter(predict_texts(
+                    model, texts.texts, sp_model=sp_model,
+                    max_len=params['max_len'],
+                    batch_size=params['batch_size'],
+                    workers=params['workers'], device=device))
+                test_df['prediction'] = torch.sigmoid(
+                    torch.from_numpy(ys[:, 0])).numpy()
+                writer.write(test_df)
 
     def train():
         nonlocal step
@@ -239,15 +453,21 @@ def main():
                              dynamic_ncols=True):
             lr_scheduler.step()
             pbar = tqdm.tqdm(train_loader, desc='train', dynamic_ncols=True)
+            n_tokens = n_padded = 0
             for batch in pbar:
                 loss_value = train_step(*batch)
                 step += 1
-                pbar.set_postfix(loss=f'{loss_value:.2f}')
+                xs, lengths = batch[:2]
+                n_tokens += int(lengths.sum())
+                n_padded += xs.numel()
+                pbar.set_postfix(loss=f'{loss_value:.2f}',
+                                 pad_eff=f'{n_tokens / n_padded:.1%}')
                 json_log_plots.write_event(
                     run_path, step * params['batch_size'], loss=loss_value)
                 if (params['validate_every'] and
                         step % params['validate_every'] == 0):
                     validate()
+            print(f'padding efficiency {n_tokens / max(1, n_padded):.1%}')
             save()
             validate()
 
@@ -262,9 +482,13 @@ def main():
         model.load_state_dict(
             torch.load(save_path, map_location=device)['state_dict'])
         if action == 'validate':
-            valid_metrics = get_validation_metrics()
+            valid_metrics, pred_df = get_validation_metrics()
             for k in MAIN_METRICS + ['valid_loss']:
                 print(f'{k:<20} {valid_metrics[k]:.4f}')
+            print(f'student auc {valid_metrics["auc"]:.4f} '
+                  f'{valid_metrics["texts_per_s"]:,.0f} texts/s')
+            if teacher is not None:
+                compare_teacher(teacher, pred_df)
         elif action == 'submit':
             submit()
 
@@ -0,0 +1,95 @@
+import gc
+from typing import Callable, Dict, List
+
+import torch
+
+
+class OutOfMemoryInUpdate(RuntimeError):
+    """ Out of memory after a function run by ``AdaptiveBatchSize``
+    has partially updated state which repeating the micro-batch does not
+    restore, e.g. in backward, which accumulates gradients layer by layer.
+    Raised from the original error.
+    """
+
+
+def is_oom(e: BaseException) -> bool:
+    """ True for CUDA out of memory and CPU allocation failures.
+    """
+    if isinstance(e, (MemoryError, OutOfMemoryInUpdate)):
+        return True
+    message = str(e)
+    return isinstance(e, RuntimeError) and (
+        'out of memory' in message or
+        "can't allocate memory" in message)
+
+
+class AdaptiveBatchSize:
+    """ Split batches into micro-batches which fit into memory.
+
+    A micro-batch size which failed with out of memory is halved and
+    remembered for its sequence length, and is used for that and
+    all longer lengths afterwards, so each length bucket fails only once.
+    """
+    def __init__(self, name: str = 'batch'):
+        self.name = name
+        self.limits: Dict[int, int] = {}
+
+    def limit(self, length: int, batch_size: int) -> int:
+        for limit_length, size in self.limits.items():
+            if limit_length <= length:
+                batch_size = min(batch_size, size)
+        return batch_size
+
+    def run(self, fn: Callable[[List[torch.Tensor], float, bool], object],
+            tensors: List[torch.Tensor]) -> list:
+        """ Return results of ``fn(micro_batch_tensors, weight, last)``
+        for micro-batches of ``tensors``, where ``weight`` is the fraction
+        of the batch in the micro-batch, and ``last`` is True for the last
+        micro-batch (e.g. to synchronize gradients only once).
+
+        Only the micro-batch which ran out of memory is repeated.
+        If ``fn`` raised ``OutOfMemoryInUpdate``, the limit is reduced and
+        it is raised again, so that the caller can restore its state
+        and repeat everything which contributed to it.
+        """
+        n, length = tensors[0].shape[:2]
+        results = []
+        start = 0
+        while start < n:
+            size = self.limit(length, n)
+            micro_batch = [t[start: start + size] for t in tensors]
+            try:
+                result = fn(micro_batch, len(micro_batch[0]) / n,
+                            start + size >= n)
+            except (RuntimeError, MemoryError) as e:
+                if not is_oom(e):
+                    raise
+                if size == 1:
+                    if isinstance(e, OutOfMemoryInUpdate) and e.__cause__:
+                        raise e.__cause__
+                    raise
+                oom = True
+                in_update = isinstance(e, OutOfMemoryInUpdate)
+            else:
+                oom = False
+            if not oom:
+                results.append(result)
+                start += size
+                continue
+            # memory is released only after the exception is gone
+            del micro_batch
+            gc.collect()
+            torch.cuda.empty_cache()
+            self.limits[length] = size // 2
+            print(f'Out of memory at {self.name} size {size} '
+                  f'and length {length}, reducing to {size // 2}')
+            if in_update:
+                raise OutOfMemoryInUpdate(
+                    f'out of memory at {self.name} size {size}')
+        return results
+
+    def state_dict(self) -> Dict[int, int]:
+        return dict(self.limits)
+
+    def load_state_dict(self, state: Dict[int, int]):
+        self.limits = dict(state)
@@ -0,0 +1,249 @@
+"""
+Mixed precision policies shared by training scripts:
+
+- ``fp32``: no mixed precision,
+- ``fp16``: native autocast to float16 with dynamic loss scaling (CUDA),
+- ``bf16``: native autocast to bfloat16, also on CPU, no loss scaling needed,
+- ``apex``: NVIDIA apex amp O1.
+
+``fp16`` and ``bf16`` need native autocast from torch >= 1.10 and are only
+offered when it is available, the pinned torch 1.1 has fp32 and apex.
+
+Compare throughput and loss against fp32 with::
+
+    python -m jigsaw.precision bert-base-uncased --precisions fp32 bf16
+"""
+import argparse
+import contextlib
+from functools import partial
+import json
+from pathlib import Path
+import time
+from typing import Dict
+
+import numpy as np
+import torch
+
+try:
+    from apex import amp
+except ImportError:
+    amp = None
+
+
+HAS_AUTOCAST = hasattr(torch, 'autocast')
+PRECISIONS = ['fp32'] + (['fp16', 'bf16'] if HAS_AUTOCAST else []) + ['apex']
+
+
+class Precision:
+    """ Full precision, and base class for other policies.
+
+    Typical use::
+
+        model, optimizer = precision.prepare(model, optimizer)
+        with precision.autocast():
+            loss = criterion(model(x), y)
+        precision.backward(loss, optimizer)
+        precision.step(optimizer)
+    """
+    name = 'fp32'
+
+    def __init__(self, device: torch.device):
+        self.device = torch.device(device)
+
+    def prepare(self, model, optimizer=None):
+        return model, optimizer
+
+    def autocast(self):
+        return contextlib.suppress()
+
+    def backward(self, loss: torch.Tensor, optimizer):
+        loss.backward()
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def state_dict(self) -> Dict:
+        return {}
+
+    def load_state_dict(self, state: Dict):
+        pass
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.device})'
+
+
+class AutocastPrecision(Precision):
+    """ Native autocast to ``dtype``, with loss scaling for float16.
+    """
+    def __init__(self, device: torch.device, dtype: torch.dtype):
+        super().__init__(device)
+        if not hasattr(torch, 'autocast'):
+            raise ValueError('native autocast needs torch >= 1.10')
+        self.dtype = dtype
+        self.name = {torch.float16: 'fp16', torch.bfloat16: 'bf16'}[dtype]
+        self.scaler = None
+        if dtype == torch.float16:
+            if self.device.type != 'cuda':
+                raise ValueError('fp16 autocast needs CUDA, use bf16 on CPU')
+            self.scaler = torch.cuda.amp.GradScaler()
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.dtype)
+
+    def backward(self, loss: torch.Tensor, optimizer):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, optimizer):
+        if self.scaler is not None:
+            # skips the step if gradients overflowed and adjusts the scale
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
+
+    def state_dict(self) -> Dict:
+        return {'scaler': self.scaler.state_dict()} if self.scaler else {}
+
+    def load_state_dict(self, state: Dict):
+        if self.scaler is not None and state.get('scaler'):
+            self.scaler.load_state_dict(state['scaler'])
+
+
+class ApexPrecision(Precision):
+    """ apex amp with O1 optimization level, patching torch functions
+    to run in float16 where it is safe.
+    """
+    name = 'apex'
+
+    def __init__(self, device: torch.device, loss_scale='dynamic'):
+        super().__init__(device)
+        self.loss_scale = loss_scale
+        if amp is None:
+            raise ValueError('apex is not installed')
+        if self.device.type != 'cuda':
+            raise ValueError('apex amp needs CUDA')
+
+    def prepare(self, model, optimizer=None):
+        if optimizer is None:
+            model = amp.initialize(model, opt_level='O1', verbosity=0,
+                                   loss_scale=self.loss_scale)
+            return model, None
+        return amp.initialize(model, optimizer, opt_level='O1', verbosity=0,
+                              loss_scale=self.loss_scale)
+
+    def backward(self, loss: torch.Tensor, optimizer):
+        with amp.scale_loss(loss, optimizer) as scaled_loss:
+            scaled_loss.backward()
+
+    def state_dict(self) -> Dict:
+        return amp.state_dict() if hasattr(amp, 'state_dict') else {}
+
+    def load_state_dict(self, state: Dict):
+        if state and hasattr(amp, 'load_state_dict'):
+            amp.load_state_dict(state)
+
+
+def get_precision(name: str, device) -> Precision:
+    """ Return precision policy by name, or the default one for the device
+    if ``name`` is None: apex if it is installed and fp16 autocast
+    otherwise on CUDA (if torch has it), and fp32 on CPU.
+    """
+    device = torch.device(device)
+    if name is None:
+        if device.type != 'cuda':
+            name = 'fp32'
+        elif amp is not None:
+            name = 'apex'
+        else:
+            name = 'fp16' if HAS_AUTOCAST else 'fp32'
+    if name == 'fp32':
+        return Precision(device)
+    elif name == 'fp16':
+        return AutocastPrecision(device, torch.float16)
+    elif name == 'bf16':
+        return AutocastPrecision(device, torch.bfloat16)
+    elif name == 'apex':
+        return ApexPrecision(device)
+    raise ValueError(f'unknown precision {name}, expected one of {PRECISIONS}')
+
+
+def main():
+    """ Train a classifier for a few steps with each precision policy
+    from the same initial weights and data, reporting throughput and
+    the difference of the loss from fp32.
+    """
+    from .bert import device, get_loss, load_model, load_tokenizer, train
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    arg = parser.add_argument
+    arg('model')
+    arg('--precisions', nargs='+', default=PRECISIONS, choices=PRECISIONS)
+    arg('--steps', type=int, default=50)
+    arg('--warmup-steps', type=int, default=5,
+        help='steps excluded from throughput')
+    arg('--batch-size', type=int, default=32)
+    arg('--seq-length', type=int, default=128)
+    arg('--lr', type=float, default=2e-5)
+    arg('--seed', type=int, default=42)
+    arg('--output', help='save results to this json file')
+    args = parser.parse_args()
+
+    _, pad_idx = load_tokenizer(args.model)
+    rng = np.random.RandomState(args.seed)
+    n_samples = args.steps * args.batch_size
+    x_train = rng.randint(1000, 2000, size=(n_samples, args.seq_length))
+    y_train = rng.rand(n_samples, 8).astype(np.float32)
+    y_train[:, 1] = 1  # loss weight
+    criterion = partial(get_loss, loss_weight=1.)
+
+    results = {}
+    for name in args.precisions:
+        try:
+            precision = get_precision(name, device)
+        except ValueError as e:
+            print(f'{name}: skipped, {e}')
+            continue
+        torch.manual_seed(args.seed)
+        model = load_model(args.model).to(device)
+        losses, times = [], []
+        start = time.perf_counter()
+        for state in train(
+                model=model, criterion=criterion,
+                x_train=x_train, y_train=y_train, epochs=1, yield_steps=1,
+                bucket=False, lr=args.lr, batch_size=args.batch_size,
+                accumulation_steps=1, pad_idx=pad_idx, seed=args.seed,
+                precision=precision):
+            smoothed_loss, train_state = state[3], state[-1]
+            if train_state['train_step'] > len(losses):  # once per step
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+                losses.append(smoothed_loss)
+        timed = np.diff(times[args.warmup_steps:])
+        results[name] = {
+            'samples_per_s': float(args.batch_size / np.mean(timed)),
+            'losses': losses,
+        }
+        del model
+
+    reference = results.get('fp32')
+    for name, result in results.items():
+        line = (f'{name}: {result["samples_per_s"]:.1f} samples/s, '
+                f'final loss {result["losses"][-1]:.4f}')
+        if reference is not None and name != 'fp32':
+            losses, ref_losses = map(np.array, [
+                result['losses'], reference['losses']])
+            result['max_loss_diff'] = float(np.abs(losses - ref_losses).max())
+            result['speedup'] = (result['samples_per_s'] /
+                                 reference['samples_per_s'])
+            line += (f', max loss diff to fp32 {result["max_loss_diff"]:.4f}'
+                     f', speedup {result["speedup"]:.2f}x')
+        print(line)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
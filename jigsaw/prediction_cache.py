@@ -0,0 +1,152 @@
+import hashlib
+import json
+from pathlib import Path
+import re
+import sqlite3
+from typing import Dict, Iterable, List
+
+import numpy as np
+import torch
+
+
+_SPACES_RE = re.compile(' +')
+
+
+def normalize_text(text: str) -> str:
+    """ Collapse runs of spaces, which do not change tokenization
+    for BERT and sentencepiece models. GPT-2 BPE keeps spaces in tokens,
+    so its texts must not be normalized.
+    """
+    return _SPACES_RE.sub(' ', text).strip(' ')
+
+
+def text_hash(text: str, normalize: bool = False) -> bytes:
+    if normalize:
+        text = normalize_text(text)
+    # raw and normalized hashes of the same text do not collide in the cache
+    return hashlib.blake2b(
+        text.encode('utf8'), digest_size=16,
+        person=b'normalized' if normalize else b'raw').digest()
+
+
+def model_fingerprint(model: torch.nn.Module, **params) -> str:
+    """ Hash of model weights and inference parameters
+    (e.g. max sequence length) which affect predictions.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for name, value in sorted(model.state_dict().items()):
+        h.update(name.encode('utf8'))
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode('utf8'))
+    return h.hexdigest()
+
+
+class PredictionCache:
+    """ On-disk cache of model outputs keyed by
+    (model fingerprint, text hash), keeping at most ``max_size``
+    least recently used entries.
+    """
+    def __init__(self, path: Path, fingerprint: str, max_size: int = 10 ** 7):
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.db = sqlite3.connect(str(path))
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            'fingerprint TEXT, hash BLOB, value BLOB, used INTEGER, '
+            'PRIMARY KEY (fingerprint, hash))')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS predictions_used '
+            'ON predictions (used)')
+        self.clock, = self.db.execute(
+            'SELECT COALESCE(MAX(used), 0) FROM predictions').fetchone()
+
+    def get_many(self, hashes: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i: i + 500]
+            rows = self.db.execute(
+                f'SELECT hash, value FROM predictions '
+                f'WHERE fingerprint = ? AND hash IN '
+                f'({",".join("?" * len(chunk))})',
+                [self.fingerprint] + chunk).fetchall()
+            found.update((h, np.frombuffer(v, dtype=np.float32))
+                         for h, v in rows)
+        if found:
+            self.clock += 1
+            self.db.executemany(
+                'UPDATE predictions SET used = ? '
+                'WHERE fingerprint = ? AND hash = ?',
+                [(self.clock, self.fingerprint, h) for h in found])
+            self.db.commit()
+        return found
+
+    def put_many(self, hashes: Iterable[bytes], values: np.ndarray):
+        self.clock += 1
+        self.db.executemany(
+            'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+            [(self.fingerprint, h, v.astype(np.float32).tobytes(), self.clock)
+             for h, v in zip(hashes, values)])
+        n_entries, = self.db.execute(
+            'SELECT COUNT(*) FROM predictions').fetchone()
+        if n_entries > self.max_size:
+            self.db.execute(
+                'DELETE FROM predictions WHERE rowid IN ('
+                'SELECT rowid FROM predictions ORDER BY used LIMIT ?)',
+                (n_entries - self.max_size,))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class DedupedTexts:
+    """ Unique texts of a batch job by text hash, normalized with
+    ``normalize`` (only for tokenizers which ignore repeated spaces).
+
+    Only ``texts`` (unique and not cached) need to be predicted,
+    ``indices`` are their positions in the input,
+    ``scatter`` maps their predictions back to all input rows
+    and stores them in the cache.
+    """
+    def __init__(self, texts: Iterable[str], cache: PredictionCache = None,
+                 normalize: bool = False):
+        self.cache = cache
+        unique = {}
+        unique_texts = []
+        first_indices = []
+        inverse = []
+        for i, text in enumerate(texts):
+            h = text_hash(text, normalize)
+            idx = unique.get(h)
+            if idx is None:
+                idx = unique[h] = len(unique)
+                unique_texts.append(text)
+                first_indices.append(i)
+            inverse.append(idx)
+        self.inverse = np.array(inverse, dtype=np.int64)
+        self.hashes = list(unique)
+        self.cached = cache.get_many(self.hashes) if cache else {}
+        self.to_predict = [i for i, h in enumerate(self.hashes)
+                           if h not in self.cached]
+        self.texts = [unique_texts[i] for i in self.to_predict]
+        self.indices = np.array([first_indices[i] for i in self.to_predict],
+                                dtype=np.int64)
+
+    def __len__(self):
+        return len(self.inverse)
+
+    def scatter(self, predictions: np.ndarray) -> np.ndarray:
+        assert len(predictions) == len(self.to_predict)
+        if self.cache is not None and len(predictions):
+            self.cache.put_many(
+                [self.hashes[i] for i in self.to_predict], predictions)
+        if self.cached:
+            n_out = len(next(iter(self.cached.values())))
+        else:
+            n_out = predictions.shape[1]
+        unique = np.zeros((len(self.hashes), n_out), dtype=np.float32)
+        unique[self.to_predict] = predictions
+        for i, h in enumerate(self.hashes):
+            if h in self.cached:
+                unique[i] = self.cached[h]
+        return unique[self.inverse]
@@ -0,0 +1,92 @@
+from queue import Queue
+import threading
+import time
+from typing import Callable, Iterable, List
+
+import torch
+
+
+class PrefetchLoader:
+    """ Iterate over batches of tensors from ``loader`` in a background
+    thread, keeping up to ``depth`` batches ready.
+
+    Each batch is passed through ``transform`` (e.g. padding trimming)
+    and moved to ``device``. On CUDA, batches are pinned and copied with
+    non-blocking transfers on a side stream, so copies overlap with the
+    forward pass. On CPU, collation overlaps with compute.
+
+    ``wait_time`` accumulates the time the consumer was blocked waiting
+    for the next batch, which is the gap between training steps.
+    """
+    def __init__(self, loader: Iterable, *, device,
+                 transform: Callable[[List[torch.Tensor]],
+                                     List[torch.Tensor]] = None,
+                 depth: int = 2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.transform = transform
+        self.depth = depth
+        self.use_cuda = self.device.type == 'cuda'
+        self.n_batches = 0
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def mean_wait(self) -> float:
+        return self.wait_time / max(1, self.n_batches)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._produce, args=(queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = queue.get()
+                self.wait_time += time.perf_counter() - start
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream()
+                    stream.wait_event(event)
+                    for tensor in batch:
+                        tensor.record_stream(stream)
+                self.n_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                while not queue.empty():
+                    queue.get_nowait()
+                thread.join(timeout=0.1)
+
+    def _produce(self, queue: Queue, stop: threading.Event):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            for batch in self.loader:
+                if stop.is_set():
+                    return
+                batch = list(batch)
+                if self.transform is not None:
+                    batch = self.transform(batch)
+                event = None
+                if self.use_cuda:
+                    with torch.cuda.stream(stream):
+                        batch = [t.pin_memory().to(
+                                     self.device, non_blocking=True)
+                                 for t in batch]
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = [t.to(self.device) for t in batch]
+                queue.put((batch, event))
+            queue.put(None)
+        except Exception as e:
+            queue.put(e)
@@ -0,0 +1,430 @@
+"""
+Local scoring service around a trained jigsaw.bert model.
+
+Serve over HTTP (POST /score with {"text": ...} or {"texts": [...]},
+GET /stats for latency and throughput counters)::
+
+    python -m jigsaw.serve serve _runs/example --port 8000
+
+or over stdin/stdout, one JSON object or raw text per line::
+
+    python -m jigsaw.serve stdio _runs/example < comments.txt
+
+Benchmark a running service with a local load generator::
+
+    python -m jigsaw.serve bench --port 8000 --concurrency 64
+"""
+import argparse
+import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+from pathlib import Path
+import random
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import torch
+
+from .bert import (
+    load_tokenizer, load_model, tokenize, binned_length, preprocess_df)
+from .utils import DATA_ROOT
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('action', choices=['serve', 'stdio', 'bench'])
+    arg('run_root', nargs='?')
+    arg('--model', default='bert-base-uncased')
+    arg('--seq-length', type=int, default=296)
+    arg('--host', default='127.0.0.1')
+    arg('--port', type=int, default=8000)
+    arg('--device', default='cpu')
+    arg('--threads', type=int, help='torch intra-op threads')
+    arg('--max-batch-size', type=int, default=32)
+    arg('--max-delay', type=float, default=0.01,
+        help='max seconds a request waits for its batch to fill')
+    arg('--tokenize-workers', type=int, default=2)
+    arg('--tokenize-processes', action='store_true',
+        help='tokenize in worker processes instead of threads')
+    # bench options
+    arg('--concurrency', type=int, default=32)
+    arg('--requests', type=int, default=2000)
+    arg('--texts', help='file with one text per line, default is test.csv')
+    args = parser.parse_args()
+
+    if args.action == 'bench':
+        asyncio.run(run_bench(args))
+        return
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    scorer = Scorer.load(args.model, args.run_root, device=args.device,
+                         max_seq_length=args.seq_length)
+    executor_cls = (ProcessPoolExecutor if args.tokenize_processes
+                    else ThreadPoolExecutor)
+    tokenize_executor = executor_cls(
+        args.tokenize_workers, initializer=_init_tokenize_worker,
+        initargs=(scorer.tokenize_fn,))
+    batcher = MicroBatcher(
+        scorer,
+        tokenize_executor=tokenize_executor,
+        max_batch_size=args.max_batch_size,
+        max_delay=args.max_delay)
+    try:
+        if args.action == 'serve':
+            asyncio.run(serve_http(batcher, args.host, args.port))
+        elif args.action == 'stdio':
+            asyncio.run(serve_stdio(batcher))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(batcher.stats.snapshot()), file=sys.stderr)
+        tokenize_executor.shutdown()
+        batcher.model_executor.shutdown()
+
+
+class Scorer:
+    """ Tokenizes texts and runs forward passes for padded id batches.
+    """
+    def __init__(self, model, tokenizer, *, pad_idx: int, use_bert: bool,
+                 max_seq_length: int, device):
+        self.model = model.to(device).eval()
+        self.device = device
+        self.pad_idx = pad_idx
+        self.tokenize_fn = _Tokenize(
+            tokenizer, max_seq_length=max_seq_length, use_bert=use_bert,
+            pad_idx=pad_idx)
+
+    @classmethod
+    def load(cls, model_name: str, run_root=None, *, device,
+             max_seq_length: int):
+        tokenizer, pad_idx = load_tokenizer(model_name)
+        model = load_model(model_name)
+        if run_root is not None:
+            model.load_state_dict(torch.load(
+                Path(run_root) / 'model-best.pt', map_location='cpu'))
+        return cls(model, tokenizer, pad_idx=pad_idx,
+                   use_bert='bert' in model_name,
+                   max_seq_length=max_seq_length, device=torch.device(device))
+
+    def predict(self, batch: List[List[int]]) -> np.ndarray:
+        max_len = max(map(len, batch))
+        x = np.full((len(batch), max_len), self.pad_idx, dtype=np.int64)
+        for i, ids in enumerate(batch):
+            x[i, :len(ids)] = ids
+        x = torch.from_numpy(x).to(self.device)
+        with torch.no_grad():
+            y_pred = self.model(
+                x, attention_mask=x != self.pad_idx, labels=None)
+        return torch.sigmoid(y_pred[:, 0]).cpu().numpy()
+
+
+class _Tokenize:
+    """ Picklable tokenization callable returning unpadded ids.
+    """
+    def __init__(self, tokenizer, **kwargs):
+        self.tokenizer = tokenizer
+        self.kwargs = kwargs
+
+    def __call__(self, text: str) -> List[int]:
+        ids = tokenize(text, tokenizer=self.tokenizer, **self.kwargs)
+        pad_idx = self.kwargs['pad_idx']
+        while len(ids) > 1 and ids[-1] == pad_idx:
+            ids.pop()
+        return ids
+
+
+_worker_tokenize = None
+
+
+def _init_tokenize_worker(tokenize_fn):
+    global _worker_tokenize
+    _worker_tokenize = tokenize_fn
+
+
+def _tokenize_in_worker(text: str) -> List[int]:
+    return _worker_tokenize(text)
+
+
+class LatencyStats:
+    def __init__(self, window: int = 10000):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.started = time.perf_counter()
+
+    def record_request(self, latency: float):
+        self.latencies.append(latency)
+        self.n_requests += 1
+
+    def record_batch(self, size: int):
+        self.batch_sizes.append(size)
+        self.n_batches += 1
+
+    def snapshot(self) -> Dict:
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000
+        stats = {
+            'requests': self.n_requests,
+            'batches': self.n_batches,
+            'throughput': self.n_requests / elapsed if elapsed else 0.,
+            'mean_batch_size': (float(np.mean(self.batch_sizes))
+                                if self.batch_sizes else 0.),
+        }
+        if len(latencies):
+            stats.update({
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+            })
+        return stats
+
+
+class MicroBatcher:
+    """ Groups concurrent requests by binned token length.
+
+    A bucket is sent to the model as soon as it is full or its oldest
+    request reaches ``max_delay``. When the model is idle, the bucket with
+    the oldest request is sent right away, so batches only grow while
+    the model is busy.
+    """
+    def __init__(self, scorer: Scorer, *, tokenize_executor,
+                 max_batch_size: int, max_delay: float):
+        self.scorer = scorer
+        self.tokenize_executor = tokenize_executor
+        self.model_executor = ThreadPoolExecutor(1)
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.buckets = defaultdict(list)
+        self.n_running = 0
+        self.stats = LatencyStats()
+
+    async def score(self, text: str) -> float:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        ids = await loop.run_in_executor(
+            self.tokenize_executor, _tokenize_in_worker, text)
+        future = loop.create_future()
+        bucket = binned_length(len(ids))
+        pending = self.buckets[bucket]
+        pending.append((ids, future, start))
+        if len(pending) >= self.max_batch_size:
+            self._dispatch(bucket)
+        elif not self.n_running:
+            self._dispatch_oldest()
+        elif len(pending) == 1:
+            loop.call_later(self.max_delay, self._on_deadline, bucket, start)
+        result = await future
+        self.stats.record_request(time.perf_counter() - start)
+        return result
+
+    def _on_deadline(self, bucket: int, start: float):
+        pending = self.buckets.get(bucket)
+        if pending and pending[0][2] <= start:
+            self._dispatch(bucket)
+
+    def _dispatch_oldest(self):
+        pending = [(items[0][2], bucket)
+                   for bucket, items in self.buckets.items() if items]
+        if pending:
+            _, bucket = min(pending)
+            self._dispatch(bucket)
+
+    def _dispatch(self, bucket: int):
+        pending = self.buckets[bucket]
+        batch = pending[:self.max_batch_size]
+        del pending[:self.max_batch_size]
+        self.n_running += 1
+        if pending:
+            asyncio.get_running_loop().call_later(
+                self.max_delay, self._on_deadline, bucket, pending[0][2])
+        asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            predictions = await loop.run_in_executor(
+                self.model_executor, self.scorer.predict,
+                [ids for ids, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+        else:
+            for (_, future, _), p in zip(batch, predictions):
+                future.set_result(float(p))
+        finally:
+            self.n_running -= 1
+            self.stats.record_batch(len(batch))
+        if not self.n_running:
+            self._dispatch_oldest()
+
+
+async def serve_http(batcher: MicroBatcher, host: str, port: int):
+    server = await asyncio.start_server(http_handler(batcher), host, port)
+    print(f'Serving on http://{host}:{port}', file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def http_handler(batcher: MicroBatcher):
+    async def handler(reader, writer):
+        try:
+            await handle_http(batcher, reader, writer)
+        finally:
+            writer.close()
+    return handler
+
+
+async def handle_http(batcher: MicroBatcher, reader, writer):
+    """ Minimal HTTP/1.1 handler with keep-alive.
+    """
+    while True:
+        request_line = await reader.readline()
+        if not request_line:
+            return
+        method, path, _ = request_line.decode('latin1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in {b'\r\n', b'\n', b''}:
+                break
+            key, value = line.decode('latin1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        status = '200 OK'
+        if method == 'GET' and path == '/stats':
+            response = batcher.stats.snapshot()
+        elif method == 'POST' and path == '/score':
+            try:
+                key, texts = _parse_score_request(body)
+            except (ValueError, KeyError) as e:
+                status, response = '400 Bad Request', {'error': str(e)}
+            else:
+                predictions = await asyncio.gather(
+                    *[batcher.score(t) for t in texts])
+                response = ({'predictions': predictions} if key == 'texts'
+                            else {'prediction': predictions[0]})
+        else:
+            status, response = '404 Not Found', {'error': 'not found'}
+        payload = json.dumps(response).encode('utf8')
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin1')
+            + payload)
+        await writer.drain()
+        if headers.get('connection', '').lower() == 'close':
+            return
+
+
+def _parse_score_request(body: bytes):
+    """ Return the key ("text" or "texts") and a list of texts,
+    raising ValueError for a malformed request.
+    """
+    request = json.loads(body.decode('utf8'))
+    if not isinstance(request, dict):
+        raise ValueError('expected a JSON object')
+    if 'texts' in request:
+        key, texts = 'texts', request['texts']
+        if not isinstance(texts, list):
+            raise ValueError('"texts" must be a list')
+    elif 'text' in request:
+        key, texts = 'text', [request['text']]
+    else:
+        raise ValueError('expected "text" or "texts"')
+    if not all(isinstance(t, str) for t in texts):
+        raise ValueError('texts must be strings')
+    return key, texts
+
+
+async def serve_stdio(batcher: MicroBatcher):
+    """ Score lines from stdin, printing JSON lines in input order.
+    """
+    loop = asyncio.get_running_loop()
+    results = deque()
+
+    async def _score(line):
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = {'text': line}
+        if not isinstance(item, dict):
+            item = {'text': line}
+        item['prediction'] = await batcher.score(item.pop('text'))
+        return item
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        results.append(asyncio.ensure_future(_score(line.rstrip('\n'))))
+        while results and results[0].done():
+            print(json.dumps(results.popleft().result()), flush=True)
+    for future in results:
+        print(json.dumps(await future), flush=True)
+
+
+async def run_bench(args):
+    """ Send ``args.requests`` requests from ``args.concurrency`` clients
+    over keep-alive connections and report client-side latencies.
+    """
+    if args.texts:
+        texts = Path(args.texts).read_text(encoding='utf8').splitlines()
+    else:
+        df = preprocess_df(pd.read_csv(DATA_ROOT / 'test.csv'))
+        texts = list(df['comment_text'].values)
+    rng = random.Random(42)
+    remaining = args.requests
+    latencies = []
+
+    async def _client():
+        nonlocal remaining
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        try:
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                await _request(reader, writer, 'POST', '/score',
+                               {'text': rng.choice(texts)})
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    print(f'{len(latencies):,} requests in {elapsed:.1f}s, '
+          f'{len(latencies) / elapsed:.1f} req/s, '
+          f'p50 {np.percentile(latencies_ms, 50):.1f} ms, '
+          f'p99 {np.percentile(latencies_ms, 99):.1f} ms')
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    print('server stats', await _request(reader, writer, 'GET', '/stats'))
+    writer.close()
+
+
+async def _request(reader, writer, method: str, path: str, data=None):
+    payload = json.dumps(data).encode('utf8') if data is not None else b''
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\n'
+        f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin1') + payload)
+    await writer.drain()
+    await reader.readline()
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in {b'\r\n', b''}:
+            break
+        key, value = line.decode('latin1').split(':', 1)
+        if key.strip().lower() == 'content-length':
+            content_length = int(value)
+    return json.loads((await reader.readexactly(content_length)).decode())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 """
 https://www.kaggle.com/bminixhofer/simple-lstm-pytorch-version
 """
+import argparse
 import os
 import time
 import random
@@ -15,6 +16,7 @@ from torch import nn
 from torch.utils import data
 from torch.nn import functional as F
 
+from .averaging import AVERAGE_KINDS, WeightAverage
 from .utils import DATA_ROOT
 
 
@@ -63,7 +65,13 @@ def sigmoid(x):
 
 def train_model(model, train, test, loss_fn, output_dim, lr=0.001,
                 batch_size=512, n_epochs=4,
-                enable_checkpoint_ensemble=True):
+                enable_checkpoint_ensemble=True, average=None,
+                average_decay=0.999):
+    """ Train the model and return test predictions, blended over epochs
+    if ``enable_checkpoint_ensemble`` is set. With ``average`` ("ema", or
+    "swa" from the second epoch) weights are averaged during training
+    instead, and test data is predicted once with the averaged weights.
+    """
     param_lrs = [{'params': param, 'lr': lr} for param in model.parameters()]
     optimizer = torch.optim.Adam(param_lrs, lr=lr)
 
@@ -76,6 +84,11 @@ def train_model(model, train, test, loss_fn, output_dim, lr=0.001,
         test, batch_size=batch_size, shuffle=False)
     all_test_preds = []
     checkpoint_weights = [2 ** epoch for epoch in range(n_epochs)]
+    weight_average = None
+    if average:
+        weight_average = WeightAverage(
+            model, kind=average, decay=average_decay,
+            start=len(train_loader) if average == 'swa' else 0)
     
     for epoch in range(n_epochs):
         start_time = time.time()
@@ -96,23 +109,22 @@ def train_model(model, train, test, loss_fn, output_dim, lr=0.001,
             loss.backward()
 
             optimizer.step()
+            if weight_average is not None:
+                weight_average.update(model)
             avg_loss += loss.item() / len(train_loader)
             
-        model.eval()
-        test_preds = np.zeros((len(test), output_dim))
-    
-        for i, x_batch in enumerate(test_loader):
-            y_pred = sigmoid(model(*x_batch).detach().cpu().numpy())
-
-            test_preds[i * batch_size:(i+1) * batch_size, :] = y_pred
-
-        all_test_preds.append(test_preds)
+        if weight_average is None:
+            all_test_preds.append(
+                predict(model, test_loader, output_dim, batch_size))
         elapsed_time = time.time() - start_time
         logging.info(
             'Epoch {}/{} \t loss={:.4f} \t time={:.2f}s'.format(
                 epoch + 1, n_epochs, avg_loss, elapsed_time))
 
-    if enable_checkpoint_ensemble:
+    if weight_average is not None:
+        weight_average.copy_to(model)
+        test_preds = predict(model, test_loader, output_dim, batch_size)
+    elif enable_checkpoint_ensemble:
         test_preds = np.average(
             all_test_preds, weights=checkpoint_weights, axis=0)
     else:
@@ -121,6 +133,16 @@ def train_model(model, train, test, loss_fn, output_dim, lr=0.001,
     return test_preds
 
 
+def predict(model, test_loader, output_dim, batch_size):
+    model.eval()
+    test_preds = np.zeros((len(test_loader.dataset), output_dim))
+    with torch.no_grad():
+        for i, x_batch in enumerate(test_loader):
+            y_pred = sigmoid(model(*x_batch).cpu().numpy())
+            test_preds[i * batch_size:(i+1) * batch_size, :] = y_pred
+    return test_preds
+
+
 class SpatialDropout(nn.Dropout2d):
     def forward(self, x):
         x = x.unsqueeze(2)    # (N, T, 1, K)
@@ -192,6 +214,14 @@ def preprocess(data):
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    arg = parser.add_argument
+    arg('--average', choices=AVERAGE_KINDS,
+        help='predict test once with averaged weights instead of '
+             'blending predictions of each epoch')
+    arg('--average-decay', type=float, default=0.999)
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s [%(levelname)s] %(module)s: %(message)s')
@@ -260,7 +290,9 @@ def main():
 
         test_preds = train_model(model, train_dataset, test_dataset,
                                  output_dim=y_train_torch.shape[-1],
-                                 loss_fn=nn.BCEWithLogitsLoss(reduction='mean'))
+                                 loss_fn=nn.BCEWithLogitsLoss(reduction='mean'),
+                                 average=args.average,
+                                 average_decay=args.average_decay)
         all_test_preds.append(test_preds)
 
     submission = pd.DataFrame.from_dict({
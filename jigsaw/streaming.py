@@ -0,0 +1,122 @@
+"""
+Streaming helpers for predictions on large csv files: reading in chunks,
+and writing a csv ordered by id without holding all rows in memory.
+"""
+import csv
+import heapq
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterator, List
+
+import pandas as pd
+
+from .utils import DATA_ROOT
+
+
+def read_chunks(path: Path = DATA_ROOT / 'test.csv', chunk_size: int = 20000,
+                nrows: int = None) -> Iterator[pd.DataFrame]:
+    """ Read a csv file in chunks of ``chunk_size`` rows.
+    """
+    yield from pd.read_csv(path, chunksize=chunk_size, nrows=nrows)
+
+
+class IdOrderedCsvWriter:
+    """ Append data frame chunks to a csv file ordered by ``key`` column
+    while keeping only one chunk in memory.
+
+    Each chunk is sorted before writing. If all chunks come in key order
+    (as in test.csv), they are appended directly to the output, else
+    sorted runs are spilled to a temporary directory and merged on close,
+    at most ``max_fan_in`` runs (open files) at a time.
+    """
+    def __init__(self, path: Path, key: str = 'id', max_fan_in: int = 64):
+        self.path = Path(path)
+        self.key = key
+        if max_fan_in < 2:
+            raise ValueError('max_fan_in should be at least 2')
+        self.max_fan_in = max_fan_in
+        self.columns = None
+        self.key_dtype = None
+        self.last_key = None
+        self.runs: List[Path] = []
+        self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir)
+
+    def write(self, df: pd.DataFrame):
+        if not len(df):
+            return
+        df = df.sort_values(self.key, kind='mergesort')
+        if self.columns is None:
+            self.columns = list(df.columns)
+            self.key_dtype = df[self.key].dtype
+            df.to_csv(self.path, index=None)
+        elif (self.tmp_dir is None and
+                df[self.key].iloc[0] > self.last_key):
+            df[self.columns].to_csv(
+                self.path, index=None, header=False, mode='a')
+        else:
+            if self.tmp_dir is None:
+                self.tmp_dir = Path(tempfile.mkdtemp(
+                    prefix='runs-', dir=self.path.parent))
+                first_run = self.tmp_dir / '0.csv'
+                self.path.rename(first_run)
+                self.runs.append(first_run)
+            run_path = self.tmp_dir / f'{len(self.runs)}.csv'
+            df[self.columns].to_csv(run_path, index=None)
+            self.runs.append(run_path)
+        last_key = df[self.key].iloc[-1]
+        if self.last_key is None or last_key > self.last_key:
+            self.last_key = last_key
+
+    def close(self):
+        if self.tmp_dir is None:
+            return
+        try:
+            runs = self.runs
+            n_merged = 0
+            # each merge opens all its runs at once, so merge in passes
+            # of at most max_fan_in runs to stay below the open files limit
+            while len(runs) > self.max_fan_in:
+                merged = []
+                for i in range(0, len(runs), self.max_fan_in):
+                    path = self.tmp_dir / f'merged-{n_merged}.csv'
+                    n_merged += 1
+                    self._merge(runs[i: i + self.max_fan_in], path)
+                    merged.append(path)
+                runs = merged
+            self._merge(runs, self.path)
+        finally:
+            shutil.rmtree(self.tmp_dir)
+            self.tmp_dir = None
+
+    def _merge(self, runs: List[Path], path: Path):
+        """ Merge sorted csv ``runs`` into ``path`` and remove them.
+        """
+        key_idx = self.columns.index(self.key)
+        key_type = (int if pd.api.types.is_integer_dtype(self.key_dtype) else
+                    float if pd.api.types.is_numeric_dtype(self.key_dtype)
+                    else str)
+        files = [run.open('rt', encoding='utf8', newline='') for run in runs]
+        try:
+            readers = [csv.reader(f) for f in files]
+            for reader in readers:
+                next(reader)  # header
+            with path.open('wt', encoding='utf8', newline='') as f:
+                writer = csv.writer(f, lineterminator='\n')
+                writer.writerow(self.columns)
+                writer.writerows(heapq.merge(
+                    *readers, key=lambda row: key_type(row[key_idx])))
+        finally:
+            for f in files:
+                f.close()
+        for run in runs:
+            run.unlink()
@@ -0,0 +1,35 @@
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+
+
+def cached_tokens(cache_root: Path, texts: List[str],
+                  tokenize: Callable[[List[str]], np.ndarray],
+                  **params) -> np.ndarray:
+    """ Return ``tokenize(texts)``, computed once for the same texts and
+    ``params`` (e.g. model name and sequence length) and stored in
+    ``cache_root``. Processes which need the same tokens at the same time
+    (e.g. folds trained in parallel) wait for the first one to tokenize.
+    The result is memory mapped, so it is shared between processes
+    and only the rows which are indexed are read. Token ids are stored
+    as int32, which fits all vocabularies and halves the size of the cache.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(params, sort_keys=True).encode('utf8'))
+    for text in texts:
+        h.update(text.encode('utf8'))
+        h.update(b'\0')
+    cache_root.mkdir(exist_ok=True, parents=True)
+    path = cache_root / f'tokens-{h.hexdigest()}.npy'
+    with open(cache_root / f'{path.name}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not path.exists():
+            tmp_path = path.with_name(f'{path.stem}.tmp.npy')
+            np.save(tmp_path, tokenize(texts).astype(np.int32))
+            os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,164 @@
+"""
+WordPiece tokenizer with a prefix trie over the vocab and a word-level
+LRU cache. Produces the same tokens as ``BertTokenizer``, check with::
+
+    python -m jigsaw.wordpiece bert-base-uncased
+"""
+import argparse
+from functools import lru_cache
+import re
+import time
+from typing import Dict, List, Tuple
+
+import pandas as pd
+from pytorch_pretrained_bert import BertTokenizer
+from pytorch_pretrained_bert.tokenization import whitespace_tokenize
+import tqdm
+
+from .utils import DATA_ROOT
+
+
+# characters BasicTokenizer treats as whitespace: space, \t, \n, \r and
+# unicode category Zs. Words between them are tokenized independently.
+_WHITESPACE_RE = re.compile(
+    '[ \t\n\r\u00a0\u1680\u2000-\u200a\u202f\u205f\u3000]+')
+
+
+class TrieBertTokenizer(BertTokenizer):
+    """ Drop-in replacement for ``BertTokenizer``.
+
+    Greedy longest-match-first WordPiece is done by walking a prefix trie
+    instead of probing the vocab with every substring, and the pieces of
+    each whitespace-delimited word are kept in an LRU cache, so frequent
+    words skip both basic tokenization and WordPiece.
+    """
+    def __init__(self, vocab_file, *args, cache_size: int = 2 ** 18,
+                 **kwargs):
+        super().__init__(vocab_file, *args, **kwargs)
+        self.cache_size = cache_size
+        self._prefix_trie, self._suffix_trie = _build_tries(self.vocab)
+        self.unk_id = self.vocab[self.wordpiece_tokenizer.unk_token]
+        self._init_cache()
+
+    def _init_cache(self):
+        self._word_ids = lru_cache(maxsize=self.cache_size)(
+            self._word_ids_uncached)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_word_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def tokenize(self, text: str) -> List[str]:
+        return [self.ids_to_tokens[idx] for idx in self.encode(text)]
+
+    def encode(self, text: str) -> List[int]:
+        """ Return WordPiece ids for ``text``, without special tokens.
+        """
+        ids = []
+        if self.do_basic_tokenize:
+            for word in _WHITESPACE_RE.split(text):
+                if word:
+                    ids.extend(self._word_ids(word))
+        else:
+            for word in whitespace_tokenize(text):
+                ids.extend(self._wordpiece_ids(word))
+        return ids
+
+    def _word_ids_uncached(self, word: str) -> Tuple[int, ...]:
+        ids = []
+        for token in self.basic_tokenizer.tokenize(word):
+            ids.extend(self._wordpiece_ids(token))
+        return tuple(ids)
+
+    def _wordpiece_ids(self, word: str) -> Tuple[int, ...]:
+        if len(word) > self.wordpiece_tokenizer.max_input_chars_per_word:
+            return self.unk_id,
+        ids = []
+        start, n_chars = 0, len(word)
+        trie = self._prefix_trie
+        while start < n_chars:
+            node = trie
+            match = None
+            for end in range(start, n_chars):
+                node = node.get(word[end])
+                if node is None:
+                    break
+                idx = node.get(None)
+                if idx is not None:
+                    match = end + 1, idx
+            if match is None:
+                return self.unk_id,
+            start, idx = match
+            ids.append(idx)
+            trie = self._suffix_trie
+        return tuple(ids)
+
+
+def _build_tries(vocab: Dict[str, int]) -> Tuple[Dict, Dict]:
+    """ Return tries for word-initial pieces and for "##" continuation
+    pieces (without the "##"). Token ids are stored under the None key.
+    """
+    prefix_trie, suffix_trie = {}, {}
+
+    def _add(trie, token, idx):
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[None] = idx
+
+    for token, idx in vocab.items():
+        _add(prefix_trie, token, idx)
+        if token.startswith('##'):
+            _add(suffix_trie, token[2:], idx)
+    return prefix_trie, suffix_trie
+
+
+def main():
+    """ Check that TrieBertTokenizer matches BertTokenizer on train.csv
+    and compare their speed.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    arg = parser.add_argument
+    arg('model', nargs='?', default='bert-base-uncased')
+    arg('--limit', type=int, help='check only first texts')
+    args = parser.parse_args()
+
+    train_pkl_path = DATA_ROOT / 'train.pkl'
+    if not train_pkl_path.exists():
+        pd.read_csv(DATA_ROOT / 'train.csv').to_pickle(train_pkl_path)
+    texts = (pd.read_pickle(train_pkl_path)['comment_text']
+             .astype(str).values[:args.limit])
+    do_lower_case = 'uncased' in args.model
+    reference = BertTokenizer.from_pretrained(
+        args.model, do_lower_case=do_lower_case)
+    tokenizer = TrieBertTokenizer.from_pretrained(
+        args.model, do_lower_case=do_lower_case)
+
+    n_mismatch = 0
+    reference_time = trie_time = 0
+    for text in tqdm.tqdm(texts):
+        t0 = time.perf_counter()
+        expected = reference.tokenize(text)
+        t1 = time.perf_counter()
+        tokens = tokenizer.tokenize(text)
+        t2 = time.perf_counter()
+        reference_time += t1 - t0
+        trie_time += t2 - t1
+        if tokens != expected:
+            n_mismatch += 1
+            if n_mismatch <= 10:
+                print(f'Mismatch for {text!r}:\n{expected}\n{tokens}')
+    print(f'{n_mismatch:,} mismatches in {len(texts):,} texts')
+    print(f'BertTokenizer {reference_time:.1f}s, '
+          f'TrieBertTokenizer {trie_time:.1f}s, '
+          f'speedup {reference_time / trie_time:.1f}x, '
+          f'cache {tokenizer._word_ids.cache_info()}')
+
+
+if __name__ == '__main__':
+    main()